@@ -0,0 +1,282 @@
+"""
+Benchmark of the wrapper itself: config parsing, gpg validation, discovery, increment counting,
+the per-line output loop and the report, with stand-ins for duplicity and gpg from bench/bin.
+
+Cases scale the number of directories (one duplicity run each) and the output of a single run.
+Wall-clock covers the whole process including the stand-ins, CPU and peak memory are backup.py only.
+
+    python bench/bench.py --dirs 10,100,1000,10000 --output-sizes 1K,1M,100M,1G
+    python bench/bench.py --save before.json
+    python bench/bench.py --compare before.json  # exit code 1 on a regression
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from hashlib import md5
+
+from prettytable import PrettyTable
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKUP_PY = os.path.join(BENCH_DIR, "..", "src", "backup.py")
+FINGERPRINT = "72214DBF0302AB802F28E243C2C018FD01FDBA9D"
+UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+@dataclass
+class Case:
+    name: str
+    dirs: int
+    output_bytes: int
+
+
+@dataclass
+class Result:
+    name: str
+    wall: float  # seconds, median of the repeats
+    cpu: float  # seconds, median of the repeats
+    peak_mb: float  # max of the repeats
+    failed: bool = False
+
+
+def parse_size(size: str) -> int:
+    size = size.strip().upper().removesuffix("B")
+    unit = size[-1] if size[-1] in UNITS and not size[-1].isdigit() else ""
+    return int(float(size[: len(size) - len(unit)]) * UNITS[unit])
+
+
+def seed_archive_cache(archive_dir: str, dest: str, incs: int) -> None:
+    """
+    Local metadata of one full and `incs` incrementals, increments are counted without duplicity.
+    """
+    target_dir = os.path.join(archive_dir, md5(dest.encode()).hexdigest())
+    os.makedirs(target_dir, exist_ok=True)
+    times = [f"202401{day:02d}T010203Z" for day in range(1, incs + 2)]
+    names = [
+        f"duplicity-full.{times[0]}.manifest",
+        f"duplicity-full-signatures.{times[0]}.sigtar.gpg",
+    ]
+    for start, end in zip(times, times[1:]):
+        names += [
+            f"duplicity-inc.{start}.to.{end}.manifest",
+            f"duplicity-new-signatures.{start}.to.{end}.sigtar.gpg",
+        ]
+    for name in names:
+        open(os.path.join(target_dir, name), "w").close()
+
+
+def prepare(work_dir: str, case: Case, incs: int, parallelism: int) -> str:
+    """
+    Create the sources, the archive cache and the config of a case, returns the config file.
+    """
+    source_dir = os.path.join(work_dir, "src")
+    dest_dir = os.path.join(work_dir, "dst")
+    archive_dir = os.path.join(work_dir, "cache", "duplicity")
+    for i in range(case.dirs):
+        item = f"dir{i:05d}"
+        os.makedirs(os.path.join(source_dir, item))
+        seed_archive_cache(archive_dir, f"file://{os.path.join(dest_dir, item)}", incs)
+    os.makedirs(os.path.join(work_dir, "gnupg"), mode=0o700)
+    config_file = os.path.join(work_dir, "backup.yml")
+    with open(config_file, "w") as f:
+        json.dump(  # YAML is a superset of JSON
+            {
+                "command": "backup",
+                "gpg": {"fingerprint": FINGERPRINT},
+                "source": {"baseDir": source_dir},
+                "dest": {"uri": "file://", "baseDir": dest_dir},
+                "all_subdirectories": True,
+                "do_full_after": incs + 1,
+                "parallelism": parallelism,
+                "email": {"server": ""},
+            },
+            f,
+        )
+    return config_file
+
+
+def bench_env(work_dir: str, output_bytes: int, latency: float, result_file: str) -> dict[str, str]:
+    """
+    Environment running backup.py with the stand-ins and the gnupg and cache dirs of `work_dir`.
+    """
+    return dict(
+        os.environ,
+        PATH=f"{os.path.join(BENCH_DIR, 'bin')}{os.pathsep}{os.environ.get('PATH', '')}",
+        GNUPGHOME=os.path.join(work_dir, "gnupg"),
+        XDG_CACHE_HOME=os.path.join(work_dir, "cache"),
+        BENCH_FINGERPRINT=FINGERPRINT,
+        BENCH_OUTPUT_BYTES=str(output_bytes),
+        BENCH_LATENCY=str(latency),
+        BENCH_RESULT=result_file,
+    )
+
+
+def run_case(case: Case, repeat: int, incs: int, latency: float, parallelism: int) -> Result:
+    walls, cpus, peaks = [], [], []
+    failed = False
+    for _ in range(repeat):
+        work_dir = tempfile.mkdtemp(prefix="dupback-bench-")
+        try:
+            config_file = prepare(work_dir, case, incs, parallelism)
+            result_file = os.path.join(work_dir, "result.json")
+            env = bench_env(work_dir, case.output_bytes, latency, result_file)
+            started = time.perf_counter()
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.join(BENCH_DIR, "measure.py"),
+                    BACKUP_PY,
+                    "--config",
+                    config_file,
+                ],
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            walls.append(time.perf_counter() - started)
+            if process.returncode != 0:
+                failed = True
+                sys.stderr.write(
+                    f"{case.name} failed with exit code {process.returncode}:\n"
+                    + process.stderr.decode(errors="replace")[-2000:]
+                )
+            with open(result_file) as f:
+                measured = json.load(f)
+            cpus.append(measured["cpu"])
+            peaks.append(measured["peak_mb"])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return Result(case.name, statistics.median(walls), statistics.median(cpus), max(peaks), failed)
+
+
+def compare(results: list[Result], baseline_file: str, tolerance: float) -> list[str]:
+    """
+    Returns the regressions against a saved run: cases more than `tolerance` slower or larger.
+    """
+    with open(baseline_file) as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get(result.name)
+        if before is None:
+            continue
+        for metric in ["wall", "cpu", "peak_mb"]:
+            old, new = before[metric], getattr(result, metric)
+            if old > 0 and new > old * (1 + tolerance):
+                regressions.append(
+                    f"{result.name}: {metric} {old:.2f} -> {new:.2f} (+{new / old - 1:.0%})"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--dirs", default="10,100,1000", help="Directory counts, comma separated.")
+    parser.add_argument(
+        "--output-sizes",
+        default="1K,1M,64M",
+        help="Output of a single duplicity run, comma separated, e.g. 1K,1G.",
+    )
+    parser.add_argument(
+        "--dir-output",
+        default="4K",
+        help="Output per directory for the directory cases.",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Seconds each duplicity run waits before its output.",
+    )
+    parser.add_argument(
+        "--incs",
+        type=int,
+        default=2,
+        help="Incrementals in the local archive cache of each directory.",
+    )
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="Write the results as JSON, to compare later runs against.")
+    parser.add_argument(
+        "--compare",
+        help="Results saved with --save, report cases that got slower or larger.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed increase with --compare.",
+    )
+    args = parser.parse_args()
+
+    cases = [
+        Case(f"dirs={count}", int(count), parse_size(args.dir_output))
+        for count in args.dirs.split(",")
+        if count
+    ]
+    cases += [
+        Case(f"output={size}", 1, parse_size(size))
+        for size in args.output_sizes.split(",")
+        if size
+    ]
+
+    table = PrettyTable()
+    table.field_names = ["Case", "Wall s", "CPU s", "Peak MB", "CPU ms/dir"]
+    table.align = "r"
+    results = []
+    for case in cases:
+        result = run_case(case, args.repeat, args.incs, args.latency, args.parallelism)
+        results.append(result)
+        table.add_row(
+            [
+                result.name + (" FAILED" if result.failed else ""),
+                f"{result.wall:.2f}",
+                f"{result.cpu:.2f}",
+                f"{result.peak_mb:.1f}",
+                f"{result.cpu * 1000 / case.dirs:.1f}" if case.dirs > 1 else "",
+            ]
+        )
+        print(
+            f"{result.name}: wall {result.wall:.2f}s, cpu {result.cpu:.2f}s, "
+            f"peak {result.peak_mb:.1f} MB",
+            file=sys.stderr,
+        )
+    print(
+        f"Python {platform.python_version()}, {args.repeat} repeats, "
+        f"latency {args.latency}s, parallelism {args.parallelism}"
+    )
+    print(table)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "created": time.time(),
+                    "results": [asdict(result) for result in results],
+                },
+                f,
+                indent=1,
+            )
+    exit_code = 1 if any(result.failed for result in results) else 0
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print("Regressions:\n" + "\n".join(f"- {regression}" for regression in regressions))
+            exit_code = 1
+        else:
+            print(f"No regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
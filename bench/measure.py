@@ -0,0 +1,31 @@
+"""
+Run a script in this process and write CPU time and peak memory of the process itself,
+without its child processes (duplicity, gpg), as JSON to the file named by BENCH_RESULT.
+
+Usage: python measure.py script.py [args]
+"""
+import json
+import os
+import resource
+import runpy
+import sys
+
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+sys.path[0] = os.path.dirname(os.path.abspath(script))
+exit_code: int | str | None = 0
+try:
+    runpy.run_path(script, run_name="__main__")
+except SystemExit as e:
+    exit_code = e.code
+finally:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with open(os.environ["BENCH_RESULT"], "w") as f:
+        json.dump(
+            {
+                "cpu": usage.ru_utime + usage.ru_stime,
+                "peak_mb": usage.ru_maxrss / 1024,  # KiB on Linux
+            },
+            f,
+        )
+sys.exit(exit_code)
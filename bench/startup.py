@@ -0,0 +1,102 @@
+"""
+Startup report of backup.py, based on `python -X importtime`: the modules imported by a run
+of one directory with the stand-ins from bench/bin, slowest first, and the interpreter start as baseline.
+Compare the report before and after a change to check the cold start.
+
+    python bench/startup.py
+    python bench/startup.py --command collection-status --top 30
+"""
+import argparse
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from prettytable import PrettyTable
+
+from bench import BACKUP_PY, BENCH_DIR, Case, bench_env, prepare
+
+# import time: self [us] | cumulative | imported package
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+
+
+def interpreter_start(repeat: int) -> float:
+    walls = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        walls.append(time.perf_counter() - started)
+    return statistics.median(walls)
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    """
+    Returns (module, self µs, cumulative µs) of the modules imported at top level, i.e. not by another module.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match and len(match[3]) == 1:
+            imports.append((match[4], int(match[1]), int(match[2])))
+    return imports
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--command", default="backup", help="backup.py command to run.")
+    parser.add_argument("--top", type=int, default=20, help="Modules to list.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of the interpreter start baseline.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="dupback-startup-")
+    try:
+        config_file = prepare(work_dir, Case("startup", 1, 0), incs=1, parallelism=1)
+        result_file = os.path.join(work_dir, "result.json")
+        started = time.perf_counter()
+        process = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                os.path.join(BENCH_DIR, "measure.py"),
+                BACKUP_PY,
+                "--config",
+                config_file,
+                "--command",
+                args.command,
+            ],
+            env=bench_env(work_dir, 0, 0, result_file),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        wall = time.perf_counter() - started
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    stderr = process.stderr.decode(errors="replace")
+    if process.returncode != 0:
+        sys.stderr.write(stderr[-2000:])
+        return 1
+
+    imports = parse_importtime(stderr)
+    baseline = interpreter_start(args.repeat)
+    table = PrettyTable()
+    table.field_names = ["Module", "Cumulative ms", "Self ms"]
+    table.align = "r"
+    table.align["Module"] = "l"  # type: ignore
+    for module, self_us, cumulative_us in sorted(imports, key=lambda i: i[2], reverse=True)[: args.top]:
+        table.add_row([module, f"{cumulative_us / 1000:.1f}", f"{self_us / 1000:.1f}"])
+    print(f"Interpreter start (python -c pass): {baseline * 1000:.0f} ms")
+    print(f"Imports: {sum(i[2] for i in imports) / 1000:.0f} ms in {len(imports)} top level modules")
+    print(f"Run of `{args.command}` with one directory, including imports: {wall * 1000:.0f} ms")
+    print(table)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
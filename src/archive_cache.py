@@ -0,0 +1,361 @@
+import logging
+import os
+import re
+import shutil
+from dataclasses import dataclass, field
+from hashlib import md5
+from typing import Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# duplicity file names, see duplicity/file_naming.py
+# e.g. duplicity-full.20240101T010203Z.manifest or duplicity-inc.20240101T010203Z.to.20240108T010203Z.vol3.difftar.gpg
+_FILENAME_RE = re.compile(
+    r"^duplicity-(?P<type>full|inc|full-signatures|new-signatures)"
+    r"\.(?P<start>\d{8}T\d{6}Z)(?:\.to\.(?P<end>\d{8}T\d{6}Z))?"
+    r"\.(?:vol(?P<volume>\d+)\.)?(?P<kind>manifest|sigtar|difftar)"
+    r"(?P<suffix>(?:\.gz|\.gpg|\.z)*)(?P<partial>\.part)?$"
+)
+
+
+def get_arg_value(args: List[str], name: str) -> str | None:
+    """
+    Returns the value of a duplicity option given in `args`, either as `--name=value` or `--name value`.
+    The last occurrence wins, like in duplicity.
+    """
+    value = None
+    for i, arg in enumerate(args):
+        if arg.startswith(f"{name}="):
+            value = arg[len(name) + 1 :]
+        elif arg == name and i + 1 < len(args):
+            value = args[i + 1]
+    return value
+
+
+# options of the backup that the other duplicity actions need to find the same archive dir and backend
+_REPOSITORY_OPTIONS = {
+    "--archive-dir",
+    "--name",
+    "--tempdir",
+    "--num-retries",
+    "--timeout",
+    "--backend-retry-delay",
+    "--use-agent",
+    "--no-encryption",
+    "--encrypt-secret-keyring",
+    "--verbosity",
+    "--log-fd",
+    "--log-file",
+}
+_REPOSITORY_OPTION_PREFIXES = (
+    "--s3-",
+    "--azure-",
+    "--b2-",
+    "--ssh-",
+    "--ssl-",
+    "--ftp-",
+    "--webdav-",
+    "--gpg-",
+    "--par2-",
+    "--idr-",
+    "--file-prefix",
+)
+
+
+def get_repository_args(args: List[str]) -> List[str]:
+    """
+    Returns the options of `args` that locate the archive dir and the backend (archive dir, name,
+    backend and credential options), for actions like `collection-status` or `remove-all-but-n-full`.
+    Backup-only options like `--skip-if-no-change` or include/exclude are left out, other actions reject them.
+    A value given as separate arg must not start with `-`, use `--option=value` for those.
+    """
+    repository_args = []
+    keep = False
+    for arg in args:
+        if not arg.startswith("-"):
+            if keep:  # value of the previous option
+                repository_args.append(arg)
+            continue
+        name = arg.split("=", 1)[0]
+        keep = name in _REPOSITORY_OPTIONS or name.startswith(_REPOSITORY_OPTION_PREFIXES)
+        if keep:
+            repository_args.append(arg)
+    return repository_args
+
+
+def get_archive_dir(args: List[str] | None = None) -> str:
+    """
+    Returns the duplicity archive dir, the local cache of manifests and signatures.
+    Same defaults as duplicity: `--archive-dir` or `$XDG_CACHE_HOME/duplicity`.
+    """
+    archive_dir = get_arg_value(args or [], "--archive-dir")
+    if not archive_dir:
+        cache_home = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+        archive_dir = os.path.join(cache_home, "duplicity")
+    return os.path.expanduser(archive_dir)
+
+
+def get_backup_name(duplicity_dest: str, args: List[str] | None = None) -> str:
+    """
+    Returns the name duplicity uses for the archive subdirectory of a target.
+    Same defaults as duplicity: `--name` or the md5 of the target url.
+    """
+    name = get_arg_value(args or [], "--name")
+    if name:
+        return name
+    return md5(duplicity_dest.encode()).hexdigest()
+
+
+def get_target_cache_dir(duplicity_dest: str, args: List[str] | None = None) -> str:
+    """
+    Returns the local archive directory of a single duplicity target.
+    """
+    return os.path.join(get_archive_dir(args), get_backup_name(duplicity_dest, args))
+
+
+@dataclass
+class BackupFile:
+    name: str
+    type: str  # full, inc, full-signatures, new-signatures
+    start: str | None  # None for full backups
+    end: str
+    kind: str  # manifest, sigtar, difftar
+    volume: int | None = None
+    partial: bool = False
+
+
+@dataclass
+class BackupSet:
+    """
+    One full or incremental backup set, identified by its time stamps.
+    """
+
+    type: str  # full or inc
+    start: str | None
+    end: str
+    manifest: str | None = None
+    signature: str | None = None
+    volumes: dict[int, str] = field(default_factory=dict)
+
+
+@dataclass
+class BackupChain:
+    """
+    A full backup set and the incremental sets depending on it, in order.
+    """
+
+    full: BackupSet
+    incs: list[BackupSet] = field(default_factory=list)
+
+    @property
+    def end(self) -> str:
+        return self.incs[-1].end if self.incs else self.full.end
+
+    @property
+    def sets(self) -> list[BackupSet]:
+        return [self.full, *self.incs]
+
+
+def parse_filename(name: str) -> BackupFile | None:
+    """
+    Parse a duplicity file name. Returns None for files not created by duplicity.
+    """
+    match = _FILENAME_RE.match(name)
+    if not match:
+        return None
+    start, end = match["start"], match["end"]
+    if end is None:  # full backups only carry their end time
+        start, end = None, start
+    return BackupFile(
+        name=name,
+        type=match["type"],
+        start=start,
+        end=end,
+        kind=match["kind"],
+        volume=int(match["volume"]) if match["volume"] else None,
+        partial=bool(match["partial"]),
+    )
+
+
+def build_chains(names: Iterable[str]) -> list[BackupChain]:
+    """
+    Group duplicity file names into backup chains, oldest chain first.
+    Incremental sets which do not link to a chain (e.g. because of a missing predecessor) are ignored.
+    """
+    sets: dict[tuple[str, str | None, str], BackupSet] = {}
+    for name in names:
+        backup_file = parse_filename(name)
+        if backup_file is None or backup_file.partial:
+            continue
+        set_type = "full" if backup_file.type.startswith("full") else "inc"
+        key = (set_type, backup_file.start, backup_file.end)
+        backup_set = sets.setdefault(
+            key, BackupSet(set_type, backup_file.start, backup_file.end)
+        )
+        if backup_file.kind == "manifest":
+            backup_set.manifest = name
+        elif backup_file.kind == "sigtar":
+            backup_set.signature = name
+        elif backup_file.volume is not None:
+            backup_set.volumes[backup_file.volume] = name
+
+    incs_by_start: dict[str, BackupSet] = {
+        s.start: s for s in sets.values() if s.type == "inc" and s.start
+    }
+    chains = []
+    for full in sorted(
+        (s for s in sets.values() if s.type == "full"), key=lambda s: s.end
+    ):
+        chain = BackupChain(full)
+        while chain.end in incs_by_start:
+            chain.incs.append(incs_by_start[chain.end])
+        chains.append(chain)
+    return chains
+
+
+def read_local_chains(
+    duplicity_dest: str, args: List[str] | None = None
+) -> list[BackupChain] | None:
+    """
+    Read the backup chains of a target from the local duplicity archive dir, without remote access.
+    Returns None if the cache is missing or stale, in that case ask duplicity instead.
+    The cache is stale if no full manifest exists, a set lacks its manifest or signatures
+    or partial files of an interrupted run are left.
+    """
+    cache_dir = get_target_cache_dir(duplicity_dest, args)
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        logger.info(f"No local archive cache for {duplicity_dest} at {cache_dir}")
+        return None
+    if any(name.endswith(".part") for name in names):
+        logger.info(f"Interrupted backup found in local archive cache {cache_dir}")
+        return None
+    chains = build_chains(names)
+    if not chains:
+        logger.info(f"No full backup in local archive cache {cache_dir}")
+        return None
+    for backup_set in chains[-1].sets:
+        if not backup_set.manifest or not backup_set.signature:
+            logger.info(
+                f"Incomplete backup set {backup_set.end} in local archive cache {cache_dir}"
+            )
+            return None
+    return chains
+
+
+def count_increments(duplicity_dest: str, args: List[str] | None = None) -> int | None:
+    """
+    Number of incrementals in the current chain from the local archive cache.
+    Returns None if the cache can not be used.
+    """
+    chains = read_local_chains(duplicity_dest, args)
+    if chains is None:
+        return None
+    return len(chains[-1].incs)
+
+
+def chain_at(chains: list[BackupChain], timestring: str) -> BackupChain | None:
+    """
+    The chain duplicity restores from for `--time timestring`: the latest full backup
+    not newer than `timestring` with its incrementals up to `timestring`.
+    `timestring` uses the duplicity format, e.g. 20240101T010203Z, so comparing strings compares times.
+    """
+    candidates = [chain for chain in chains if chain.full.end <= timestring]
+    if not candidates:
+        return None
+    chain = candidates[-1]
+    return BackupChain(chain.full, [inc for inc in chain.incs if inc.end <= timestring])
+
+
+@dataclass
+class TargetCacheUsage:
+    name: str  # subdirectory of the archive dir, see get_backup_name
+    size: int
+    chains: int
+    last_used: float  # newest mtime in the directory
+
+
+def _dir_usage(path: str) -> tuple[int, float]:
+    size, last_used = 0, 0.0
+    for entry in os.scandir(path):
+        st = entry.stat(follow_symlinks=False)
+        if entry.is_dir(follow_symlinks=False):
+            sub_size, sub_last_used = _dir_usage(entry.path)
+            size += sub_size
+            last_used = max(last_used, sub_last_used)
+        else:
+            size += st.st_size
+        last_used = max(last_used, st.st_mtime)
+    return size, last_used
+
+
+def cache_usage(archive_dir: str) -> list[TargetCacheUsage]:
+    """
+    Size and last use of each target in the archive dir, largest first.
+    """
+    usage = []
+    try:
+        entries = [entry for entry in os.scandir(archive_dir) if entry.is_dir()]
+    except FileNotFoundError:
+        return usage
+    for entry in entries:
+        size, last_used = _dir_usage(entry.path)
+        chains = len(build_chains(os.listdir(entry.path)))
+        usage.append(TargetCacheUsage(entry.name, size, chains, last_used))
+    return sorted(usage, key=lambda target: target.size, reverse=True)
+
+
+def evict_old_chains(
+    duplicity_dest: str, args: List[str] | None = None, keep: int = 1
+) -> int:
+    """
+    Delete the local manifests and signatures of all but the last `keep` chains of a target,
+    e.g. after `remove-all-but-n-full` removed them remotely. Returns the bytes freed.
+    Nothing is deleted while partial files of an interrupted run are left.
+    """
+    cache_dir = get_target_cache_dir(duplicity_dest, args)
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return 0
+    if keep < 1 or any(name.endswith(".part") for name in names):
+        return 0
+    freed = 0
+    for chain in build_chains(names)[:-keep]:
+        for backup_set in chain.sets:
+            for name in [backup_set.manifest, backup_set.signature, *backup_set.volumes.values()]:
+                if not name:
+                    continue
+                path = os.path.join(cache_dir, name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+    if freed:
+        logger.info(f"Evicted {freed} bytes of old chains from local archive cache {cache_dir}")
+    return freed
+
+
+def evict_lru(archive_dir: str, max_size: int, keep_names: set[str]) -> list[TargetCacheUsage]:
+    """
+    Delete least recently used targets until the archive dir is below `max_size` bytes.
+    Targets in `keep_names` are never deleted, duplicity would have to download their signatures again.
+    Returns the deleted targets.
+    """
+    usage = cache_usage(archive_dir)
+    total = sum(target.size for target in usage)
+    evicted = []
+    for target in sorted(usage, key=lambda target: target.last_used):
+        if total <= max_size:
+            break
+        if target.name in keep_names:
+            continue
+        shutil.rmtree(os.path.join(archive_dir, target.name))
+        total -= target.size
+        evicted.append(target)
+        logger.info(f"Evicted {target.name} ({target.size} bytes) from local archive cache {archive_dir}")
+    if total > max_size:
+        logger.warning(
+            f"Local archive cache {archive_dir} is {total} bytes, above its limit of {max_size} bytes, "
+            "with the targets of the configured directories alone."
+        )
+    return evicted
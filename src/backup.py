@@ -1,34 +1,48 @@
 #!/usr/bin/env python3
-import json
 import sys
 import os
 import pathlib
 import time
-from sh import gpg, duplicity  # type: ignore
-import sh
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from jsonargparse import ArgumentParser, ActionConfigFile, Namespace
-from typing import Callable, List, Tuple
+from typing import TYPE_CHECKING, Callable, List, Tuple
 import textwrap
-import regex as re
 
-from result_reader import ResultReader, EmailSender, DummySender
+from result_reader import (
+    BackupStat,
+    ResultReader,
+    EmailSender,
+    DummySender,
+    JsonStreamDecoder,
+    format_size,
+)
+from archive_cache import (
+    cache_usage,
+    count_increments,
+    evict_lru,
+    evict_old_chains,
+    get_archive_dir,
+    get_backup_name,
+    get_repository_args,
+    read_local_chains,
+)
+from change_index import ChangeIndex
+from metrics import MetricsExporter
+from history import RunHistory
+from full_policy import FullDecision, FullPolicy
+from governor import IOGovernor
+from scheduler import Job, JobScheduler, estimate_seconds
+from preflight import SourceScan, preflight_scan
+from sharding import Shard, ShardLayout, ShardManifest, plan_shards
+from gpg_cache import GpgStateCache
 
 import logging
-import logging.handlers
-
-
-logging.basicConfig(level=logging.INFO)
-
-logFormatter = logging.Formatter(
-    "%(asctime)s [%(filename)s:%(lineno)s - %(funcName)20s() ] [%(levelname)-5.5s]  %(message)s"
-)
 
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-# logging.getLogger().addHandler(consoleHandler)
-logging.getLogger().handlers[0].setFormatter(
-    logFormatter
-)  # reconfigure the root logger
+if TYPE_CHECKING:
+    import sh
+    from change_journal import ChangeJournal
 
 
 class ConfigurationIssue(Exception):
@@ -99,6 +113,12 @@ class ConfigParser:
             required=False,
             help="Private key in pem format (password protected).",
         )
+        parser.add_argument(
+            "--gpg.cache",
+            type=bool,
+            default=True,
+            help="Remember a successful key validation in the gnupg home (dupback-gpg-state.json) and skip the gpg checks until the keyring or the keys in the config change.",
+        )
         parser.add_argument(
             "--source.baseDir",
             type=str,
@@ -165,6 +185,18 @@ class ConfigParser:
             default=["local-storage"],
             help="List of storage class names to consider for k8s local-storage discovery. Default: ['local-storage']",
         )
+        parser.add_argument(
+            "--k8s-local-storage-discovery.cache",
+            type=bool,
+            default=False,
+            help="Keep discovery results in the duplicity archive dir and reuse them while no PV and no skip labeled PVC changed (checked by metadata-only lists). Results depending on the node of a pod are not cached.",
+        )
+        parser.add_argument(
+            "--k8s-local-storage-discovery.cache-max-age",
+            type=int,
+            default=168,
+            help="Hours after which cached discovery results are rebuilt, even without changes.",
+        )
             
         parser.add_argument(
             "--no-default-config",
@@ -180,12 +212,277 @@ class ConfigParser:
             help="Create a full backup after given # incrementals. It is recommend to use this with duplicity option --skip-if-no-change. Otherwise you may want to use duplicity option --full-if-older-than",
         )
 
+        parser.add_argument(
+            "--increments-from-cache",
+            type=bool,
+            default=True,
+            help="Count incrementals for --do-full-after from the local duplicity archive dir. Falls back to `duplicity collection-status` if the cache is missing or stale.",
+        )
+        parser.add_argument(
+            "--parallelism",
+            type=int,
+            required=False,
+            default=1,
+            help="Number of directories backed up at the same time. Each directory runs its own duplicity process.",
+        )
         parser.add_argument(
             "--keep-n-full",
             required=False,
             default=0,
             help="Clean up with duplicity `remove-all-but-n-full` to clean up",
         )
+        parser.add_argument(
+            "--cleanup-after-backups",
+            type=bool,
+            default=False,
+            help="Run the clean ups (`keep-n-full`) after all backups. By default a directory is cleaned up while the next ones are backed up.",
+        )
+        parser.add_argument(
+            "--archive-cache.report",
+            type=bool,
+            default=False,
+            help="Add the size of the local duplicity archive dir per target to the report footer.",
+        )
+        parser.add_argument(
+            "--archive-cache.evict-removed-chains",
+            type=bool,
+            default=False,
+            help="After a clean up, delete the local signatures and manifests of chains beyond `keep-n-full`.",
+        )
+        parser.add_argument(
+            "--archive-cache.max-size",
+            type=float,
+            default=0,
+            help="Limit of the local duplicity archive dir in GB. Least recently used targets of directories not in `directories` (e.g. removed ones, or those of other deployments sharing the cache volume) are deleted above it. 0: no limit.",
+        )
+        parser.add_argument(
+            "--archive-cache.warm",
+            type=bool,
+            default=False,
+            help="Before the backups, verify the local archive cache of each directory and sync missing or stale ones from remote (`duplicity collection-status`), in parallel.",
+        )
+        parser.add_argument(
+            "--preflight.enabled",
+            type=bool,
+            default=False,
+            help="Walk all source directories in parallel before the run, honouring include/exclude options in `args`. Reports file count, size and changes per directory, missing sources and unreadable paths.",
+        )
+        parser.add_argument(
+            "--preflight.workers",
+            type=int,
+            default=8,
+            help="Threads walking the source directories.",
+        )
+        parser.add_argument(
+            "--preflight.fail-on-error",
+            type=bool,
+            default=False,
+            help="Abort the run if a source is missing or paths can't be read. Otherwise missing sources are skipped and errors are listed in the report.",
+        )
+        parser.add_argument(
+            "--sharding.enabled",
+            type=bool,
+            default=False,
+            help="Split directories above `max-size` or `max-files` into shards by their subdirectories, each backed up to an own target (`<directory>.shard-01`, ..., `<directory>.rest`). The layout is kept in the archive dir, new subdirectories go to the rest shard.",
+        )
+        parser.add_argument(
+            "--sharding.max-size",
+            type=float,
+            default=500,
+            help="Size in GB above which a directory is sharded, also the target size of a shard. 0: no limit.",
+        )
+        parser.add_argument(
+            "--sharding.max-files",
+            type=int,
+            default=0,
+            help="Number of files above which a directory is sharded. 0: no limit.",
+        )
+        parser.add_argument(
+            "--sharding.max-depth",
+            type=int,
+            default=3,
+            help="Levels of subdirectories split to get shards below the limits.",
+        )
+        parser.add_argument(
+            "--daemon.enabled",
+            type=bool,
+            default=False,
+            help="Stay resident and back up each directory on its cron schedule instead of once. Config, gpg validation, discovery and run history are kept between runs.",
+        )
+        parser.add_argument(
+            "--daemon.schedule",
+            type=str,
+            default="0 2 * * *",
+            help="Cron schedule (minute hour day month weekday, local time) of directories without an own schedule.",
+        )
+        parser.add_argument(
+            "--daemon.schedules",
+            type=List[str],
+            default=[],
+            help='Own schedules as "<cron>=<directory patterns>", e.g. "0 * * * *=projects,mail" or "0 3 * * 0=photos-20*". The first matching entry wins.',
+        )
+        parser.add_argument(
+            "--daemon.status-address",
+            type=str,
+            default="127.0.0.1",
+            help="Address of the status endpoint (/status as JSON, /healthz).",
+        )
+        parser.add_argument(
+            "--daemon.status-port",
+            type=int,
+            default=8080,
+            help="Port of the status endpoint, 0: no endpoint.",
+        )
+        parser.add_argument(
+            "--daemon.rediscover",
+            type=float,
+            default=24,
+            help="Hours between updates of the directories with `all-subdirectories` or the k8s discovery. 0: only at start.",
+        )
+        parser.add_argument(
+            "--change-index.enabled",
+            type=bool,
+            default=False,
+            help="Keep a local index (max mtime, file count, size) of every source directory and skip directories unchanged since their last successful backup, without starting duplicity.",
+        )
+        parser.add_argument(
+            "--change-index.inode-digest",
+            type=bool,
+            default=False,
+            help="Add a digest of inode and ctime of all entries to the change index. Detects changes which keep mtime and size.",
+        )
+        parser.add_argument(
+            "--change-journal.enabled",
+            type=bool,
+            default=False,
+            help="Skip directories and shards without changes since their last successful backup, without scanning them. Changes are recorded with Linux inotify by the daemon, or for single runs by a watcher process (`watch-only`) sharing the archive dir. Directories above the watch limit (fs.inotify.max_user_watches), all directories after lost events and all directories without a running watcher fall back to scanning.",
+        )
+        parser.add_argument(
+            "--change-journal.watch-only",
+            type=bool,
+            default=False,
+            help="Don't back up, only watch the directories and keep the change journal in the archive dir for the backup runs, e.g. as sidecar of the backup CronJob sharing its cache volume.",
+        )
+        parser.add_argument(
+            "--change-journal.max-age",
+            type=float,
+            default=60,
+            help="Seconds since the watcher last wrote the change journal, after which single runs don't trust it. Single runs wait for the next write of the watcher (every 10 seconds) before they start.",
+        )
+        parser.add_argument(
+            "--metrics.textfile",
+            type=str,
+            default="",
+            help="Write per-directory metrics in Prometheus text format to this file, e.g. for the node-exporter textfile collector (*.prom).",
+        )
+        parser.add_argument(
+            "--metrics.pushgateway-url",
+            type=str,
+            default="",
+            help="Push per-directory metrics to this Prometheus Pushgateway, e.g. http://pushgateway:9091",
+        )
+        parser.add_argument(
+            "--metrics.job",
+            type=str,
+            default="dupback",
+            help="Job name metrics are pushed under. Use one per backup config.",
+        )
+        parser.add_argument(
+            "--history.enabled",
+            type=bool,
+            default=False,
+            help="Keep the statistics of every run in a SQLite database next to the duplicity archive dir and flag directories far outside their historical baseline in the report.",
+        )
+        parser.add_argument(
+            "--history.anomaly-threshold",
+            type=float,
+            default=3.5,
+            help="Robust z-score (median/MAD) above which elapsed time, delta size or throughput of a directory is reported as anomaly.",
+        )
+        parser.add_argument(
+            "--history.window",
+            type=int,
+            default=30,
+            help="Number of past runs of a directory used as baseline.",
+        )
+        parser.add_argument(
+            "--history.min-runs",
+            type=int,
+            default=5,
+            help="Minimum number of past runs before a directory is checked for anomalies.",
+        )
+        parser.add_argument(
+            "--full-policy.enabled",
+            type=bool,
+            default=False,
+            help="Decide full or incremental per directory from the measured cost of its backup chain (needs the run history, which is recorded then). `do_full_after` is used for directories without history.",
+        )
+        parser.add_argument(
+            "--full-policy.max-inc-ratio",
+            type=float,
+            default=0.5,
+            help="Full backup is due if the incrementals of a chain add up to this share of the full backup size.",
+        )
+        parser.add_argument(
+            "--full-policy.max-restore-hours",
+            type=float,
+            default=12,
+            help="Full backup is due if restoring the chain is estimated to take longer.",
+        )
+        parser.add_argument(
+            "--full-policy.restore-rate",
+            type=float,
+            default=20,
+            help="Download rate in MB/s assumed for the restore time estimate.",
+        )
+        parser.add_argument(
+            "--full-policy.inc-restore-overhead",
+            type=float,
+            default=60,
+            help="Seconds added per incremental to the restore time estimate.",
+        )
+        parser.add_argument(
+            "--full-policy.upload-budget",
+            type=float,
+            default=0,
+            help="Estimated GB of full backups per run, further due fulls are deferred. 0: unlimited.",
+        )
+        parser.add_argument(
+            "--full-policy.stagger-days",
+            type=int,
+            default=7,
+            help="Due full backups of a directory run on one of this many nights only, so not all directories go full at once.",
+        )
+        parser.add_argument(
+            "--governor.upload-schedule",
+            type=List[str],
+            default=[],
+            help="Total upload budget of all directory jobs in MB/s by time of day, e.g. '[\"22:00=0\", \"06:00=2\"]' (0: unlimited). Shared fairly between running jobs, Linux only.",
+        )
+        parser.add_argument(
+            "--governor.read-schedule",
+            type=List[str],
+            default=[],
+            help="Total disk read budget of all directory jobs in MB/s by time of day, same format as upload-schedule.",
+        )
+        parser.add_argument(
+            "--governor.interval",
+            type=float,
+            default=0.5,
+            help="Seconds between I/O measurements of the duplicity processes.",
+        )
+        parser.add_argument(
+            "--job-order.longest-first",
+            type=bool,
+            default=False,
+            help="Start the directories with the longest expected duration first (from the run history, which is recorded then), so one big directory does not decide the finish time.",
+        )
+        parser.add_argument(
+            "--job-order.window",
+            type=int,
+            default=0,
+            help="Nightly window in minutes. Directories expected to end after it are deferred to the next run and listed in the report. 0: no window.",
+        )
         parser.add_argument(
             "--log-level",
             required=False,
@@ -211,11 +508,24 @@ class ConfigParser:
 
     def _validate_gpg_settings(self) -> Tuple[bool, str]:
         if self._cfg_d.gpg.fingerprint == "":
-            cp.usage()
+            self.usage()
             msg = "You MUST set `gpg.fingerprint` to a valid GPG public key. Use gpg --list-keys to see what's available.\n"
             logging.error(msg)
             return False, msg
         else:
+            gpg_keys = (
+                self._cfg_d.gpg.fingerprint,
+                self._cfg_d.gpg.public_key_pem,
+                self._cfg_d.gpg.private_key_pem,
+            )
+            gpg_cache = GpgStateCache() if self._cfg_d.gpg.cache else None
+            if gpg_cache and gpg_cache.is_valid(*gpg_keys):
+                logging.info("Keyring unchanged since the last validation, skip gpg checks.")
+                return True, ""
+
+            import sh
+            from sh import gpg  # type: ignore
+
             try:
                 public_key_available = self._cfg_d.gpg.fingerprint in gpg(  # type: ignore
                     "--list-keys",
@@ -296,6 +606,8 @@ class ConfigParser:
                             StdOut: {sh_err.stdout}
                             StrErr: {sh_err.stderr}\n"""
                         return False, msg
+            if gpg_cache:
+                gpg_cache.store(*gpg_keys)
             return True, ""
 
     def _validate_url(self) -> Tuple[bool, str]:
@@ -310,7 +622,9 @@ class ConfigParser:
         if self._cfg_d.all_subdirectories:
             # replacing directories with all subdirectories of source base dir
             rootdir = f"{self._cfg_d.source.baseDir}"
-            if pathlib.Path(rootdir):
+            if not pathlib.Path(rootdir).is_dir():
+                return False, f"Source base dir {rootdir} not found.\n"
+            else:
                 subdirs = [
                     x.name
                     for x in os.scandir(rootdir)
@@ -319,7 +633,17 @@ class ConfigParser:
                 self._cfg_d.update(subdirs, "directories")
         elif self._cfg_d.k8s_local_storage_discovery.enabled and node is not None:
             from k8s_local_storage_discovery import K8sLocalStorageDiscovery
-            local_storage = K8sLocalStorageDiscovery(self._cfg_d.k8s_local_storage_discovery.storage_class_names)
+            discovery_cfg = self._cfg_d.k8s_local_storage_discovery
+            cache_file = None
+            if discovery_cfg.cache:
+                cache_file = os.path.join(
+                    get_archive_dir(self._cfg_d.args), "dupback-k8s-discovery.json"
+                )
+            local_storage = K8sLocalStorageDiscovery(
+                discovery_cfg.storage_class_names,
+                cache_file=cache_file,
+                cache_max_age=discovery_cfg.cache_max_age * 3600,
+            )
 
             directories = local_storage.get_local_storage_dirs_for_node(node)
             source, directories = local_storage.discover_common_path(directories, self._cfg_d.source.baseDir)
@@ -333,6 +657,14 @@ class ConfigParser:
             return False, "No Source directories found"
         return True, ""
 
+    def rediscover(self) -> None:
+        """
+        Update `directories` from the subdirectories of the source base dir or the k8s local storage discovery.
+        """
+        status, msg = self._validate_sourcedir()
+        if not status:
+            logging.warning(msg)
+
     def add_sublevel_arguments(
         self, sublevel: str, parameters: Callable, required=False
     ):
@@ -352,7 +684,13 @@ class ConfigParser:
 
 
 def get_no_of_increments(duplicityDest):
-    pattern = re.compile(r"\{(?:[^{}]|(?R))*\}")
+    from sh import duplicity  # type: ignore
+
+    if config.increments_from_cache:
+        inc_count = count_increments(duplicityDest, config.args)
+        if inc_count is not None:
+            return inc_count
+        logging.info(f"Local archive cache not usable, ask duplicity for {duplicityDest}")
     inc_count = 0
     try:
         dup_out = "No output"
@@ -365,8 +703,7 @@ def get_no_of_increments(duplicityDest):
                 "--jsonstat",
             ]
         )
-        dub_jsons = pattern.findall(dup_out)[0]
-        dub_json = json.loads(dub_jsons)
+        dub_json = JsonStreamDecoder().feed(str(dup_out))[0][0]
         index_stat = dub_json.popitem()[1]
         inc_count = index_stat["json_stat"]["backup_meta"]["no_of_inc"]
     except Exception as e:
@@ -377,59 +714,89 @@ def get_no_of_increments(duplicityDest):
     return inc_count
 
 
-# precedence:
-# 1. args (override all)
-# 2. config file (overridden by above)
-# 3. environment variables (overridden by above)
-# 4. default values (overridden by above)
-
-sender_params = EmailSender.get_params()
-cp = ConfigParser()
-cp.add_sublevel_arguments("email", sender_params)
-try:
-    config = cp()
-    if config.email.server:
-        email_param = EmailSender.EmailParameter(**config.email.as_dict())
-        sender = EmailSender(email_param)
-    else:
-        sender = DummySender()
-    rr = ResultReader(sender, title=config.title)
+class DirectoryJobError(Exception):
+    """
+    Raised by a directory job if duplicity or the job itself failed. Carries the partial results of the job.
+    """
+
+    def __init__(self, result: ResultReader, error: Exception) -> None:
+        super().__init__(str(error))
+        self.result = result
+        self.error = error
 
-except ConfigurationIssue as ci:
-    cp.usage()
-    logging.error(ci)
-    exit(2)
 
-if config.log_level:
-    logging.getLogger().setLevel(config.log_level)
+class JobLogAdapter(logging.LoggerAdapter):
+    """
+    Prefix log lines with the directory of the job, to keep parallel jobs apart.
+    """
 
-for item in config.directories:
-    duplicitySource = os.path.join(config.source.baseDir, item)
-    duplicityDest = f"{config.dest.uri}{os.path.join(config.dest.baseDir, item)}"
+    def process(self, msg, kwargs):
+        return f"[{self.extra['job']}] {msg}", kwargs  # type: ignore
 
-    if not pathlib.Path(duplicitySource):
+
+def run_directory(item: str) -> ResultReader:
+    """
+    Run duplicity for a single directory or shard of a directory.
+    All output is collected in an own ResultReader, which is merged into the report by the caller.
+    """
+    import sh
+    from sh import duplicity  # type: ignore
+
+    log = JobLogAdapter(logging.getLogger(__name__), {"job": item})
+    job_rr = ResultReader(DummySender(), title=item)
+    command = config.command
+    duplicitySource = get_source(item)
+    duplicityDest = get_destination(item)
+    label = get_job_label(item)
+
+    if command in ["inc", "backup", "full", ""] and not pathlib.Path(duplicitySource).exists():
         sys.stderr.write(f"Couldn't find source {duplicitySource}. Skipping.\n")
-        continue
+        job_rr.add_skipped(label, "source not found")
+        return job_rr
+
+    directory = shard_jobs[item][0].item if item in shard_jobs else item
+    journal_seq = None
+    if change_journal and command in ["inc", "backup", ""]:
+        journal_seq = change_journal.seq
+        if is_journal_unchanged(item):
+            log.info(f"No changes recorded since last backup, skipping {label}")
+            job_rr.add_skipped(label, "no changes recorded since last backup")
+            return job_rr
+
+    tree_summary = None
+    if change_index and command in ["inc", "backup", ""]:
+        tree_summary = change_index.scan(duplicitySource)
+        if change_index.is_unchanged(duplicityDest, tree_summary):
+            log.info(f"No changes since last backup, skipping {label}")
+            job_rr.add_skipped(label, "unchanged since last backup")
+            if change_journal and journal_seq is not None:
+                change_journal.mark_backed_up(directory, item, journal_seq)
+            return job_rr
 
-    if config.do_full_after > 0 and config.command in ["inc", "backup", ""]:
-        if get_no_of_increments(duplicityDest) >= config.do_full_after:
-            config.command = "full"
+    if command in ["inc", "backup", ""]:
+        decision = full_plan.get(label) if full_plan else None
+        if decision is not None:
+            if decision.full:
+                command = "full"
+        elif config.do_full_after > 0:
+            if get_no_of_increments(duplicityDest) >= config.do_full_after:
+                command = "full"
 
     duplicity_args = []
     skip_dest = skip_source = False
-    if "full" == config.command:
-        duplicity_args.append(config.command)
-    elif "restore" == config.command or "verify" in config.command:
+    if "full" == command:
+        duplicity_args.append(command)
+    elif "restore" == command or "verify" in command:
         duplicityDest, duplicitySource = duplicitySource, duplicityDest
-        duplicity_args.append(config.command)
+        duplicity_args.append(command)
     elif any(
         [
-            x in config.command
+            x in command
             for x in ["collection-status", "remove", "cleanup", "list-current-files"]
         ]
     ):
         skip_source = True
-        duplicity_args.append(config.command)
+        duplicity_args.append(command)
     else:
         duplicity_args.append("backup")
     if config.args:
@@ -437,6 +804,9 @@ for item in config.directories:
             duplicity_args.extend(config.args)  # no nested lists
         else:
             duplicity_args.append(config.args)
+    if item in shard_jobs and command in ["inc", "backup", "full", ""]:
+        layout, shard = shard_jobs[item]
+        duplicity_args.extend(shard.duplicity_args(duplicitySource, layout.assigned))
     if not skip_source:
         duplicity_args.append(duplicitySource)
     if not skip_dest:
@@ -444,36 +814,797 @@ for item in config.directories:
 
     prettyArgs = " ".join(duplicity_args)
     out = f"Running: duplicity --encrypt-key {config.gpg.fingerprint} {prettyArgs}\n"
-    logging.info(out)
+    log.info(out)
 
     try:
         duplicity_sh = duplicity.bake(encrypt_key=config.gpg.fingerprint)
-        for line in duplicity_sh(duplicity_args, _iter=True):
-            rr.add_json(line)
-            logging.info(line.strip())
-        if config.keep_n_full > 0 and config.command in ["inc", "backup", "full"]:
-            cleanup_out = duplicity_sh(
-                [
-                    "remove-all-but-n-full",
-                    str(config.keep_n_full),
-                    "--force",
-                    duplicityDest,
-                ]
+        process = duplicity_sh(duplicity_args, _iter=True)
+        if governor:
+            governor.register(item, process.pid)
+        try:
+            for line in process:
+                job_rr.add_json(line)
+                log.info(line.strip())
+        finally:
+            if governor:
+                governor.unregister(item)
+        job_rr.flush()
+        for stat in job_rr.stats:
+            if item in shard_jobs:
+                # shards share the source directory, keep history and metrics apart
+                stat.source = label
+            if stat.action:
+                continue
+            if command in ["inc", "backup", ""]:
+                # duplicity `backup` starts a new chain if there is none
+                stat.action = "full" if stat.no_of_inc == 0 else "inc"
+            else:
+                stat.action = command
+        if change_index and tree_summary:
+            change_index.update(duplicityDest, tree_summary)
+        if change_journal and journal_seq is not None:
+            change_journal.mark_backed_up(directory, item, journal_seq)
+        if config.keep_n_full > 0 and command in ["inc", "backup", "full"]:
+            cleanup_stage.submit(
+                item, duplicityDest, job_rr.stats[-1] if job_rr.stats else None
             )
-            if not "No old backup sets found, nothing deleted" in cleanup_out:
-                cleanup_out = textwrap.indent(cleanup_out, "." * 9 + " ")
-                msg = f"Clean up: {duplicityDest}\n{cleanup_out}"
-                logging.info(msg)
-                rr.add_footer(msg)
 
     except sh.ErrorReturnCode as sh_err:
-        rr.add_error(
+        job_rr.add_error(
             f"""ERROR exitcode: {sh_err.exit_code}
                      ============== 
                      {sh_err.stderr.decode()}
                      ============== """
         )
-        rr.parse_and_send()
-        print(f"ERROR exitcode: {sh_err.stderr.decode()}")
-        raise sh_err
-rr.parse_and_send()
+        raise DirectoryJobError(job_rr, sh_err)
+    return job_rr
+
+
+def run_directory_job(item: str) -> ResultReader:
+    """
+    Run a directory job, unexpected errors of the job are reported as its result like duplicity errors.
+    """
+    try:
+        return run_directory(item)
+    except DirectoryJobError:
+        raise
+    except Exception as e:
+        logging.exception(f"Backup job of {item} failed")
+        job_rr = ResultReader(DummySender(), title=item)
+        job_rr.add_error(f"ERROR {get_job_label(item)}: {e!r}")
+        raise DirectoryJobError(job_rr, e) from e
+
+
+def run_cleanup(item: str, duplicityDest: str, stat: BackupStat | None) -> ResultReader:
+    """
+    Remove all but `keep_n_full` full backups of a directory.
+    Skipped without remote access if the local archive cache has no more chains than that.
+    """
+    import sh
+    from sh import duplicity  # type: ignore
+
+    log = JobLogAdapter(logging.getLogger(__name__), {"job": item})
+    cleanup_rr = ResultReader(DummySender(), title=item)
+    chains = read_local_chains(duplicityDest, config.args)
+    if chains is not None and len(chains) <= config.keep_n_full:
+        log.info(f"{len(chains)} backup chain(s) in local archive cache, no clean up needed")
+        return cleanup_rr
+    cleanup_start = time.monotonic()
+    try:
+        cleanup_out = duplicity.bake(encrypt_key=config.gpg.fingerprint)(
+            [
+                "remove-all-but-n-full",
+                str(config.keep_n_full),
+                "--force",
+                *get_repository_args(config.args),  # same archive dir and backend as the backup
+                duplicityDest,
+            ]
+        )
+    except sh.ErrorReturnCode as sh_err:
+        cleanup_rr.add_error(
+            f"""Clean up of {duplicityDest} failed, exitcode: {sh_err.exit_code}
+                     ============== 
+                     {sh_err.stderr.decode()}
+                     ============== """
+        )
+        return cleanup_rr
+    if stat:
+        stat.cleanuptime = round(time.monotonic() - cleanup_start, 2)
+    if config.archive_cache.evict_removed_chains:
+        evict_old_chains(duplicityDest, config.args, config.keep_n_full)
+    if not "No old backup sets found, nothing deleted" in cleanup_out:
+        cleanup_out = textwrap.indent(cleanup_out, "." * 9 + " ")
+        msg = f"Clean up: {duplicityDest}\n{cleanup_out}"
+        log.info(msg)
+        cleanup_rr.add_footer(msg)
+    return cleanup_rr
+
+
+class CleanupStage:
+    """
+    Clean up stage of a run: one clean up at a time, started as soon as the backup of a directory
+    succeeded (concurrently with the other backups) or after all backups.
+    """
+
+    def __init__(self, concurrent: bool = True) -> None:
+        self.concurrent = concurrent
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cleanup")
+        self._lock = threading.Lock()
+        self._pending: list[tuple[str, str, BackupStat | None]] = []
+        self._futures: list[Future] = []
+
+    def submit(self, item: str, duplicityDest: str, stat: BackupStat | None) -> None:
+        with self._lock:
+            if self.concurrent:
+                self._futures.append(
+                    self._executor.submit(run_cleanup, item, duplicityDest, stat)
+                )
+            else:
+                self._pending.append((item, duplicityDest, stat))
+
+    def finish(self) -> list[ResultReader]:
+        """
+        Run pending clean ups, wait for all and return their results in submission order.
+        """
+        with self._lock:
+            for args in self._pending:
+                self._futures.append(self._executor.submit(run_cleanup, *args))
+            self._pending = []
+        self._executor.shutdown(wait=True)
+        return [future.result() for future in self._futures]
+
+
+def get_destination(item: str) -> str:
+    return f"{config.dest.uri}{os.path.join(config.dest.baseDir, item)}"
+
+
+def get_source(item: str) -> str:
+    if item in shard_jobs:
+        item = shard_jobs[item][0].item
+    return os.path.join(config.source.baseDir, item)
+
+
+def get_job_label(item: str) -> str:
+    """
+    Source of the job in reports, history and metrics. `<source>#<shard>` for shards of a directory.
+    """
+    if item in shard_jobs:
+        return f"{get_source(item)}#{shard_jobs[item][1].name}"
+    return get_source(item)
+
+
+def is_journal_unchanged(item: str) -> bool:
+    """
+    True if the change journal has no changes of the directory or shard job since its last backup.
+    """
+    if item in shard_jobs:
+        layout, shard = shard_jobs[item]
+        return change_journal.is_unchanged(
+            layout.item, item, lambda path: shard.covers(path, layout.assigned)
+        )
+    return change_journal.is_unchanged(item, item)
+
+
+def skip_journal_unchanged(directories: List[str]) -> List[str]:
+    """
+    Leave out directories without recorded changes in any of their targets,
+    before the pre-flight scan or the sharding walk them.
+    """
+    manifest = ShardManifest(get_archive_dir(config.args)) if config.sharding.enabled else None
+    changed = []
+    for item in directories:
+        layout = manifest.layouts.get(item) if manifest else None
+        if layout:
+            unchanged = all(
+                change_journal.is_unchanged(
+                    item,
+                    layout.job_name(shard),
+                    lambda path, shard=shard: shard.covers(path, layout.assigned),
+                )
+                for shard in layout.shards
+            )
+        else:
+            unchanged = change_journal.is_unchanged(item, item)
+        if unchanged:
+            rr.add_skipped(
+                os.path.join(config.source.baseDir, item), "no changes recorded since last backup"
+            )
+        else:
+            changed.append(item)
+    if len(changed) < len(directories):
+        logging.info(
+            f"No changes recorded since last backup, skipping {sorted(set(directories) - set(changed))}"
+        )
+    return changed
+
+
+def warm_archive_cache(directories: List[str], parallelism: int = 1) -> None:
+    """
+    Sync the local archive cache of directories without usable cache from remote before the backups start,
+    so a lost cache volume costs one parallel download instead of one per backup.
+    """
+    import sh
+    from sh import duplicity  # type: ignore
+
+    stale = [
+        get_destination(item)
+        for item in directories
+        if read_local_chains(get_destination(item), config.args) is None
+    ]
+    if not stale:
+        logging.info("Local archive cache of all directories verified.")
+        return
+    logging.info(f"Sync local archive cache from remote for {stale}")
+
+    def sync(duplicityDest: str) -> None:
+        try:
+            # same archive dir as read_local_chains checks, without the backup-only options
+            duplicity.bake(encrypt_key=config.gpg.fingerprint)(
+                ["collection-status", *get_repository_args(config.args), duplicityDest]
+            )
+        except sh.ErrorReturnCode as sh_err:
+            # e.g. a new directory without backup yet
+            logging.warning(f"Can't sync archive cache of {duplicityDest}: {sh_err.stderr.decode()}")
+
+    with ThreadPoolExecutor(max_workers=max(1, parallelism), thread_name_prefix="warm") as executor:
+        list(executor.map(sync, stale))
+
+
+def get_all_targets() -> List[str]:
+    """
+    Targets of all configured directories, sharded directories by their shard targets.
+    Not only those of the current run: in daemon mode a run covers the due directories only.
+    """
+    manifest = ShardManifest(get_archive_dir(config.args)) if config.sharding.enabled else None
+    targets = []
+    for item in config.directories:
+        layout = manifest.layouts.get(item) if manifest else None
+        if layout:
+            targets.extend(layout.job_name(shard) for shard in layout.shards)
+        else:
+            targets.append(item)
+    return targets
+
+
+def maintain_archive_cache() -> None:
+    """
+    Apply the size limit to the local archive dir and report its size per target.
+    The caches of all configured directories are kept, also those not part of the current run.
+    """
+    archive_dir = get_archive_dir(config.args)
+    targets = get_all_targets()
+    if config.archive_cache.max_size > 0:
+        keep_names = {get_backup_name(get_destination(item), config.args) for item in targets}
+        evict_lru(archive_dir, int(config.archive_cache.max_size * 1e9), keep_names)
+    if config.archive_cache.report:
+        names = {get_backup_name(get_destination(item), config.args): item for item in targets}
+        usage = cache_usage(archive_dir)
+        lines = [
+            f"- {names.get(target.name, target.name)}: {format_size(target.size)}, {target.chains} chain(s)"
+            for target in usage
+        ]
+        rr.add_footer(
+            f"Archive cache {archive_dir}: {format_size(sum(target.size for target in usage))}\n"
+            + "\n".join(lines)
+        )
+
+
+def run_directories(directories: List[str], parallelism: int = 1) -> None:
+    """
+    Run all directory jobs through a pool of `parallelism` workers.
+    Results are merged in the order of `directories`, independent of the order the jobs finish.
+    On the first failing job, pending jobs are cancelled, the report is sent and the error re-raised.
+    """
+    failed: DirectoryJobError | None = None
+    if config.archive_cache.warm:
+        warm_archive_cache(directories, parallelism)
+    if governor:
+        governor.start()
+    with ThreadPoolExecutor(
+        max_workers=max(1, parallelism), thread_name_prefix="duplicity"
+    ) as executor:
+        futures = [executor.submit(run_directory_job, item) for item in directories]
+        for future in as_completed(futures):
+            if future.cancelled() or future.exception() is None:
+                continue
+            # cancelled futures are never reported by as_completed, stop waiting for them
+            executor.shutdown(wait=False, cancel_futures=True)
+            failed = future.exception()  # type: ignore
+            break
+    if governor:
+        governor.stop()
+    cleanup_results = cleanup_stage.finish()
+
+    for future in futures:
+        if future.cancelled():
+            continue
+        error = future.exception()
+        if isinstance(error, DirectoryJobError):
+            rr.merge(error.result)
+        else:
+            rr.merge(future.result())
+    for cleanup_rr in cleanup_results:
+        rr.merge(cleanup_rr)
+    maintain_archive_cache()
+
+    if change_index:
+        change_index.save()
+    if change_journal:
+        change_journal.save_baselines()
+
+    if isinstance(failed, DirectoryJobError):
+        import sh
+
+        finish_run(success=False)
+        if isinstance(failed.error, sh.ErrorReturnCode):
+            print(f"ERROR exitcode: {failed.error.stderr.decode()}")
+        raise failed.error
+
+
+def run_preflight(directories: List[str]) -> Tuple[List[str], dict[str, SourceScan]]:
+    """
+    Scan the sources before the run. Returns the directories to back up and the scan of each source.
+    Changes are counted since the start of the last backup known to the history.
+    """
+    sources = {os.path.join(config.source.baseDir, item): item for item in directories}
+    since = {}
+    if history:
+        for source in sources:
+            last = history.query(source, limit=1)
+            if last and last[0].starttime > 0:
+                since[source] = last[0].starttime
+    scans = preflight_scan(list(sources), config.args, since, config.preflight.workers)
+    lines = []
+    errors = []
+    for scan in scans:
+        if scan.missing:
+            rr.add_skipped(scan.source, "source not found")
+            continue
+        changes = (
+            f", changed {scan.changed_files} files ({format_size(scan.changed_size)})"
+            if scan.source in since
+            else ""
+        )
+        lines.append(f"- {scan.source}: {scan.files} files, {format_size(scan.size)}{changes}")
+        errors.extend(scan.errors)
+    logging.info("Pre-flight scan:\n" + "\n".join(lines))
+    rr.add_plain("Pre-flight scan:\n" + "\n".join(lines))
+    if errors:
+        shown = "\n".join(errors[:50])
+        more = f"\n... {len(errors) - 50} more" if len(errors) > 50 else ""
+        rr.add_error(f"Pre-flight scan found {len(errors)} unreadable paths:\n{shown}{more}")
+    if config.preflight.fail_on_error and (errors or any(scan.missing for scan in scans)):
+        finish_run(success=False)
+        logging.error("Pre-flight scan failed, abort.")
+        sys.exit(1)
+    return [sources[scan.source] for scan in scans if not scan.missing], {
+        scan.source: scan for scan in scans
+    }
+
+
+def shard_directories(directories: List[str], scans: dict[str, SourceScan]) -> List[str]:
+    """
+    Plan shards for directories above the limits and replace sharded directories by their shard jobs.
+    New layouts are only planned for backups, from the pre-flight scan or the last run in the history.
+    """
+    manifest = ShardManifest(get_archive_dir(config.args))
+    sharding_cfg = config.sharding
+    planned = []
+    for item in directories:
+        if item in manifest.layouts or config.command not in ["inc", "backup", "full", ""]:
+            continue
+        source = os.path.join(config.source.baseDir, item)
+        scan = scans.get(source)
+        last = history.query(source, limit=1) if history and scan is None else []
+        if last:
+            size, files = last[0].sourcefilesize, last[0].sourcefiles
+        else:
+            if scan is None:
+                # first run without pre-flight, later runs take the size from the history
+                scan = preflight_scan([source], config.args, workers=config.preflight.workers)[0]
+            if scan.missing:
+                continue
+            size, files = scan.size, scan.files
+        layout = plan_shards(
+            source,
+            item,
+            size,
+            files,
+            int(sharding_cfg.max_size * 1e9),
+            sharding_cfg.max_files,
+            sharding_cfg.max_depth,
+            config.args,
+            config.preflight.workers,
+        )
+        if layout:
+            manifest.layouts[item] = layout
+            planned.append(
+                f"- {source}: {files} files, {format_size(size)} split into "
+                + ", ".join(
+                    f"{shard.name} ({len(shard.paths)} dirs, {format_size(shard.size)})"
+                    if shard.paths
+                    else f"{shard.name} ({format_size(shard.size)})"
+                    for shard in layout.shards
+                )
+            )
+    if planned:
+        manifest.save()
+        rr.add_plain("New shard layouts:\n" + "\n".join(planned))
+
+    jobs = []
+    for item in directories:
+        layout = manifest.layouts.get(item)
+        if layout is None:
+            jobs.append(item)
+            continue
+        if config.command in ["restore", "verify"]:
+            # shard jobs would all restore into, or compare against, the whole source directory
+            targets = ", ".join(layout.job_name(shard) for shard in layout.shards)
+            msg = (
+                f"{os.path.join(config.source.baseDir, item)} is sharded, "
+                f"{config.command} each of its targets on its own: {targets}"
+            )
+            logging.error(msg)
+            rr.add_error(msg)
+            continue
+        for shard in layout.shards:
+            job = layout.job_name(shard)
+            shard_jobs[job] = (layout, shard)
+            jobs.append(job)
+    return jobs
+
+
+def finish_run(success: bool) -> None:
+    """
+    Check the results against the history, send the report and export metrics.
+    """
+    if history:
+        anomalies = history.find_anomalies(
+            rr.stats,
+            config.history.anomaly_threshold,
+            config.history.window,
+            config.history.min_runs,
+        )
+        if anomalies:
+            rr.add_plain(
+                "Anomalies, far outside the historical baseline:\n"
+                + "\n".join(f"- {anomaly}" for anomaly in anomalies)
+            )
+        history.record(rr.stats, success)
+    rr.parse_and_send()
+    if latest_stats is not None:
+        latest_stats.update((stat.source, stat) for stat in rr.stats)
+        metrics.export(latest_stats.values(), success, run_stats=rr.stats)
+    else:
+        metrics.export(rr.stats, success)
+
+
+# state of the run, set up by main() and shared by the directory jobs
+config: Namespace
+rr: ResultReader
+change_index: ChangeIndex | None = None
+change_journal: "ChangeJournal | None" = None  # fed by the ChangeWatcher of the daemon or a watcher process
+metrics: MetricsExporter
+cleanup_stage: CleanupStage
+governor: IOGovernor
+history: RunHistory | None = None
+shard_jobs: dict[str, tuple[ShardLayout, Shard]] = {}
+full_plan: dict[str, FullDecision | None] | None = None
+latest_stats: dict[str, BackupStat] | None = None  # daemon: last stats of each source, for the metrics
+
+
+def run_once(directories: List[str], sender) -> bool:
+    """
+    One run over `directories`: plan, back up, clean up and report. Returns True without errors.
+    """
+    global rr, cleanup_stage, governor, shard_jobs, full_plan
+
+    rr = ResultReader(sender, title=config.title)
+    cleanup_stage = CleanupStage(concurrent=not config.cleanup_after_backups)
+    governor = IOGovernor(
+        config.governor.upload_schedule,
+        config.governor.read_schedule,
+        config.governor.interval,
+    )
+    job_order = config.job_order
+    source_scans: dict[str, SourceScan] = {}
+    if change_journal and config.command in ["inc", "backup", ""]:
+        directories = skip_journal_unchanged(directories)
+    if config.preflight.enabled and config.command in ["inc", "backup", "full", ""]:
+        directories, source_scans = run_preflight(directories)
+    shard_jobs = {}
+    if config.sharding.enabled:
+        directories = shard_directories(directories, source_scans)
+    full_plan = None
+    if config.full_policy.enabled and history and config.command in ["inc", "backup", ""]:
+        policy_cfg = config.full_policy
+        full_plan = FullPolicy(
+            history,
+            policy_cfg.max_inc_ratio,
+            policy_cfg.max_restore_hours,
+            policy_cfg.restore_rate,
+            policy_cfg.inc_restore_overhead,
+            policy_cfg.upload_budget,
+            policy_cfg.stagger_days,
+        ).plan(get_job_label(item) for item in directories)
+        reasons = [
+            f"- {source}: {'full backup, ' if decision.full else ''}{decision.reason}"
+            for source, decision in full_plan.items()
+            if decision and decision.reason
+        ]
+        if reasons:
+            rr.add_plain("Full backup policy:\n" + "\n".join(reasons))
+    if history and config.command in ["inc", "backup", "full", ""] and (
+        job_order.longest_first or job_order.window > 0
+    ):
+        jobs = []
+        for item in directories:
+            source = get_job_label(item)
+            decision = full_plan.get(source) if full_plan else None
+            full = config.command == "full" or bool(decision and decision.full)
+            if item in shard_jobs:
+                size = shard_jobs[item][1].size
+            else:
+                size = source_scans[source].size if source in source_scans else None
+            jobs.append(
+                Job(
+                    item,
+                    source,
+                    estimate_seconds(history, source, full),
+                    size,
+                )
+            )
+        scheduled, deferred = JobScheduler(
+            get_archive_dir(config.args),
+            config.parallelism,
+            job_order.window,
+            job_order.longest_first,
+        ).plan(jobs)
+        directories = [job.item for job in scheduled]
+        for job, reason in deferred:
+            rr.add_skipped(job.source, reason)
+    run_directories(directories, config.parallelism)
+    success = not rr.error_msg and not any(stat.errors > 0 for stat in rr.stats)
+    finish_run(success)
+    return success
+
+
+def run_daemon(cp: ConfigParser, sender) -> None:
+    """
+    Stay resident and run each directory on its cron schedule, one run at a time.
+    Directories due at the same time share a run and its report. Config, gpg validation, discovery,
+    run history, change index and the latest metrics are kept between runs.
+    With the change journal, the directories are watched for changes in the background.
+    SIGTERM stops the daemon after the current run.
+    """
+    global latest_stats, change_journal
+    import signal
+    from change_journal import ChangeWatcher
+    from daemon import CronSchedule, DaemonStatus, DirectorySchedules, StatusServer, sleep_until
+
+    daemon_cfg = config.daemon
+    if config.command not in ["inc", "backup", "full", ""]:
+        logging.error(f"The daemon runs backups only, not `{config.command}`.")
+        sys.exit(2)
+    try:
+        schedules = DirectorySchedules(daemon_cfg.schedule, daemon_cfg.schedules)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(2)
+    latest_stats = {}
+    status = DaemonStatus()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    server = None
+    if daemon_cfg.status_port > 0:
+        server = StatusServer(daemon_cfg.status_address, daemon_cfg.status_port, status)
+        server.start()
+    watcher = None
+    if change_journal:
+        try:
+            watcher = ChangeWatcher(change_journal, config.source.baseDir)
+            watcher.start()
+        except OSError as e:
+            logging.warning(f"Can't watch for changes, change journal disabled: {e}")
+            change_journal = None
+
+    rediscover = daemon_cfg.rediscover > 0 and (
+        config.all_subdirectories or config.k8s_local_storage_discovery.enabled
+    )
+    next_discovery = datetime.now() + timedelta(hours=daemon_cfg.rediscover)
+    next_runs: dict[str, tuple[CronSchedule, datetime]] = {}
+
+    def plan_directories() -> None:
+        now = datetime.now()
+        for item in list(next_runs):
+            if item not in config.directories:
+                del next_runs[item]
+        for item in config.directories:
+            if item not in next_runs:
+                schedule = schedules.for_directory(item)
+                next_runs[item] = (schedule, schedule.next_after(now))
+        status.set_directories(next_runs)
+        if watcher:
+            watcher.watch(config.directories)
+
+    def directory_results(items: List[str]) -> dict[str, tuple[bool, str, float]]:
+        results = {}
+        for item in items:
+            source = os.path.join(config.source.baseDir, item)
+            stats = [
+                stat
+                for stat in rr.stats
+                if stat.source == source or stat.source.startswith(f"{source}#")
+            ]
+            if stats:
+                results[item] = (
+                    all(stat.errors == 0 for stat in stats),
+                    stats[0].action,
+                    sum(max(stat.elapsedtime, 0) for stat in stats),
+                )
+            elif any(skipped == source for skipped, _ in rr.skipped):
+                results[item] = (True, "skipped", -1)
+        return results
+
+    plan_directories()
+    logging.info(
+        "Daemon started, next runs:\n"
+        + "\n".join(
+            f"- {item}: {next_run:%Y-%m-%d %H:%M} ({schedule.spec})"
+            for item, (schedule, next_run) in next_runs.items()
+        )
+    )
+    while not stop.is_set():
+        wake_up = min(
+            (next_run for _, next_run in next_runs.values()),
+            default=datetime.now() + timedelta(hours=1),
+        )
+        sleep_until(min(wake_up, next_discovery) if rediscover else wake_up, stop)
+        if stop.is_set():
+            break
+        if rediscover and datetime.now() >= next_discovery:
+            cp.rediscover()
+            next_discovery = datetime.now() + timedelta(hours=daemon_cfg.rediscover)
+            plan_directories()
+        now = datetime.now()
+        due = [item for item, (_, next_run) in next_runs.items() if next_run <= now]
+        if not due:
+            continue
+        status.start_run(due)
+        success = False
+        try:
+            success = run_once(due, sender)
+        except (Exception, SystemExit) as e:
+            # the report of the run is sent already, keep the daemon alive for the next runs
+            logging.error(f"Run of {due} failed: {e!r}")
+        status.finish_run(due, success, directory_results(due))
+        for item in due:
+            schedule = next_runs[item][0]
+            next_runs[item] = (schedule, schedule.next_after(datetime.now()))
+        status.set_directories(next_runs)
+    logging.info("Daemon stopped.")
+    if watcher:
+        watcher.stop()
+    if server:
+        server.stop()
+
+
+def run_watcher(cp: ConfigParser) -> None:
+    """
+    Only watch the directories and keep the change journal in the archive dir, for single runs
+    with `change_journal.enabled` sharing it. SIGTERM stops the watcher.
+    """
+    import signal
+    from change_journal import ChangeJournal, ChangeWatcher
+
+    journal = ChangeJournal(get_archive_dir(config.args), config.sharding.max_depth)
+    try:
+        watcher = ChangeWatcher(journal, config.source.baseDir)
+    except OSError as e:
+        logging.error(f"Can't watch for changes: {e}")
+        sys.exit(1)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    watcher.start()
+    watcher.watch(config.directories)
+    logging.info(f"Watching {config.directories}, change journal {journal.path}")
+
+    rediscover = config.daemon.rediscover > 0 and (
+        config.all_subdirectories or config.k8s_local_storage_discovery.enabled
+    )
+    next_discovery = datetime.now() + timedelta(hours=config.daemon.rediscover)
+    while not stop.wait(60):
+        if rediscover and datetime.now() >= next_discovery:
+            cp.rediscover()
+            next_discovery = datetime.now() + timedelta(hours=config.daemon.rediscover)
+            watcher.watch(config.directories)
+    watcher.stop()
+    logging.info("Watcher stopped.")
+
+
+def setup_logging() -> None:
+    logging.basicConfig(level=logging.INFO)
+    logFormatter = logging.Formatter(
+        "%(asctime)s [%(filename)s:%(lineno)s - %(funcName)20s() ] [%(levelname)-5.5s]  %(message)s"
+    )
+    logging.getLogger().handlers[0].setFormatter(logFormatter)  # reconfigure the root logger
+
+
+def main() -> None:
+    """
+    Parse and validate the config, then run all directories once, as daemon or only watch them.
+    """
+    global config, change_index, change_journal, metrics, history
+
+    setup_logging()
+
+    # precedence:
+    # 1. args (override all)
+    # 2. config file (overridden by above)
+    # 3. environment variables (overridden by above)
+    # 4. default values (overridden by above)
+
+    sender_params = EmailSender.get_params()
+    cp = ConfigParser()
+    cp.add_sublevel_arguments("email", sender_params)
+    try:
+        config = cp()
+        if config.email.server:
+            email_param = EmailSender.EmailParameter(**config.email.as_dict())
+            sender = EmailSender(email_param)
+        else:
+            sender = DummySender()
+
+    except ConfigurationIssue as ci:
+        cp.usage()
+        logging.error(ci)
+        exit(2)
+
+    if config.log_level:
+        logging.getLogger().setLevel(config.log_level)
+
+    if config.change_journal.watch_only:
+        run_watcher(cp)
+        return
+
+    change_index = None
+    if config.change_index.enabled:
+        change_index = ChangeIndex(
+            get_archive_dir(config.args), config.change_index.inode_digest
+        )
+    change_journal = None
+    if config.change_journal.enabled:
+        from change_journal import ChangeJournal
+
+        if config.daemon.enabled:
+            # the daemon watches itself, from a new session
+            change_journal = ChangeJournal(get_archive_dir(config.args), config.sharding.max_depth)
+        else:
+            change_journal = ChangeJournal.load(
+                get_archive_dir(config.args), config.change_journal.max_age
+            )
+    metrics = MetricsExporter(
+        config.metrics.textfile,
+        config.metrics.pushgateway_url,
+        config.metrics.job,
+        state_dir=get_archive_dir(config.args),
+    )
+    job_order = config.job_order
+    history = None
+    if (
+        config.history.enabled
+        or config.full_policy.enabled
+        or job_order.longest_first
+        or job_order.window > 0
+        or config.sharding.enabled
+    ):
+        history = RunHistory(get_archive_dir(config.args))
+
+    if config.daemon.enabled:
+        run_daemon(cp, sender)
+    else:
+        run_once(config.directories, sender)
+
+
+if __name__ == "__main__":
+    main()
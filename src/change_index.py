@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, asdict
+from hashlib import blake2b
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = "dupback-change-index.json"
+
+
+@dataclass
+class TreeSummary:
+    """
+    Cheap fingerprint of a directory tree, compared between runs to detect changes without duplicity.
+    Directory mtimes are part of `max_mtime_ns`, so deleted and renamed entries are detected too.
+    """
+
+    max_mtime_ns: int = 0
+    file_count: int = 0
+    total_size: int = 0
+    digest: str = ""
+    errors: int = 0  # entries that couldn't be read, the tree counts as changed
+
+
+def scan_tree(path: str, inode_digest: bool = False) -> TreeSummary:
+    """
+    Walk `path` without following symlinks and summarize it.
+
+    Args:
+        path (str): root of the tree
+        inode_digest (bool): additionally hash inode and ctime of every entry.
+            Catches changes that keep mtime and size, e.g. chmod, chown or `touch -r`.
+    Returns:
+        TreeSummary: summary of the tree, with `errors` counting unreadable entries
+            (no permission, removed during the scan, not a directory)
+    """
+    summary = TreeSummary()
+    digest = 0
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            if current == path:
+                summary.max_mtime_ns = os.stat(path).st_mtime_ns
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        logger.warning(f"Can't read {entry.path}, {path} counts as changed: {e}")
+                        summary.errors += 1
+                        continue
+                    summary.max_mtime_ns = max(summary.max_mtime_ns, st.st_mtime_ns)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        summary.file_count += 1
+                        summary.total_size += st.st_size
+                    if inode_digest:
+                        # xor keeps the digest independent of the order of scandir
+                        entry_hash = blake2b(
+                            f"{entry.path}\0{st.st_ino}\0{st.st_ctime_ns}".encode(),
+                            digest_size=16,
+                        ).digest()
+                        digest ^= int.from_bytes(entry_hash, "big")
+        except OSError as e:
+            logger.warning(f"Can't read {current}, {path} counts as changed: {e}")
+            summary.errors += 1
+    if inode_digest:
+        summary.digest = f"{digest:032x}"
+    return summary
+
+
+class ChangeIndex:
+    """
+    Persistent index of TreeSummary per backup target, stored next to the duplicity archive dir.
+    Entries are only updated after a successful backup, so a failed run is retried next time.
+    """
+
+    def __init__(self, archive_dir: str, inode_digest: bool = False) -> None:
+        self.path = os.path.join(archive_dir, INDEX_FILE_NAME)
+        self.inode_digest = inode_digest
+        self._lock = threading.Lock()
+        self._entries: dict[str, TreeSummary] = {}
+        try:
+            with open(self.path) as f:
+                self._entries = {
+                    key: TreeSummary(**value) for key, value in json.load(f).items()
+                }
+        except FileNotFoundError:
+            logger.info(f"No change index found at {self.path}, all directories are scanned as changed.")
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring broken change index {self.path}: {e}")
+
+    def scan(self, source: str) -> TreeSummary:
+        return scan_tree(source, self.inode_digest)
+
+    def is_unchanged(self, target: str, summary: TreeSummary) -> bool:
+        """
+        True if `summary` matches the summary of the last successful backup of `target`.
+        Never for a summary with unreadable entries, their changes are unknown.
+        """
+        if summary.errors:
+            return False
+        with self._lock:
+            return self._entries.get(target) == summary
+
+    def update(self, target: str, summary: TreeSummary) -> None:
+        if summary.errors:
+            return
+        with self._lock:
+            self._entries[target] = summary
+
+    def save(self) -> None:
+        """
+        Write the index atomically, a crash while writing keeps the previous index.
+        """
+        with self._lock:
+            data = {key: asdict(value) for key, value in self._entries.items()}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,410 @@
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import select
+import struct
+import threading
+import time
+import uuid
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE_NAME = "dupback-change-journal.json"
+BASELINES_FILE_NAME = "dupback-change-baselines.json"
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def truncate_path(rel_path: str, depth: int) -> str:
+    """
+    First `depth` components of a path relative to the watched directory.
+    """
+    return "/".join(rel_path.split("/")[:depth]) if rel_path else ""
+
+
+class ChangeJournal:
+    """
+    Changed paths per configured directory, recorded by a ChangeWatcher: the one of the daemon,
+    or a watcher process (`change_journal.watch_only`) for single runs sharing the archive dir.
+
+    A backup target (directory or shard) counts as unchanged if it was backed up successfully
+    while its directory was watched and no change covered by it was recorded since the backup started.
+    Changes are ordered by a sequence number, changes during a backup keep the target dirty.
+    The watcher writes the journal, the backups write their baselines to an own file.
+    Both belong to one watcher session: changes while no watcher was running are unknown,
+    so after a restart of the watcher or a lost watch every target is backed up or scanned once again.
+    """
+
+    def __init__(self, archive_dir: str, depth: int = 3) -> None:
+        self.path = os.path.join(archive_dir, JOURNAL_FILE_NAME)
+        self.baselines_path = os.path.join(archive_dir, BASELINES_FILE_NAME)
+        self.depth = max(depth, 1)
+        self.session = uuid.uuid4().hex
+        self.seq = 0
+        self._lock = threading.Lock()
+        # directory -> seq from which on all changes in its tree are recorded
+        self._watched: dict[str, int] = {}
+        # directory -> changed path (relative, truncated to `depth`) -> seq of its last change
+        self._changes: dict[str, dict[str, int]] = {}
+        # directory -> target -> seq at the start of its last successful backup
+        self._clean: dict[str, dict[str, int]] = {}
+
+    @classmethod
+    def load(cls, archive_dir: str, max_age: float) -> "ChangeJournal | None":
+        """
+        The journal of a running watcher process with the baselines of the earlier backups in its session.
+        Waits for the next save of the watcher, so that all changes before the call are in the journal.
+        None if there is no journal or its watcher stopped writing it more than `max_age` seconds ago.
+        """
+        journal = cls(archive_dir)
+        started = time.time()
+        while True:
+            try:
+                with open(journal.path) as f:
+                    data = json.load(f)
+                saved = data["saved"]
+                journal.session = data["session"]
+                journal.depth = data["depth"]
+                journal.seq = data["seq"]
+                journal._watched = data["watched"]
+                journal._changes = data["changes"]
+            except FileNotFoundError:
+                logger.warning(f"No change journal at {journal.path}, is the watcher running? All directories are scanned.")
+                return None
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Ignoring broken change journal {journal.path}: {e}")
+                return None
+            if data.get("stopped"):
+                logger.warning(f"The watcher of change journal {journal.path} stopped. All directories are scanned.")
+                return None
+            if saved > started:
+                break
+            if time.time() - saved > max_age:
+                logger.warning(
+                    f"Change journal {journal.path} was last written {time.time() - saved:.0f}s ago, "
+                    "its watcher is not running. All directories are scanned."
+                )
+                return None
+            time.sleep(1)
+        journal._clean = journal._load_baselines()
+        return journal
+
+    def _load_baselines(self) -> dict[str, dict[str, int]]:
+        try:
+            with open(self.baselines_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning(f"Ignoring broken change journal baselines {self.baselines_path}: {e}")
+            return {}
+        # baselines of another watcher session don't cover the changes of this one
+        return data.get("clean", {}) if data.get("session") == self.session else {}
+
+    def record(self, item: str, rel_path: str) -> None:
+        path = truncate_path(rel_path, self.depth)
+        with self._lock:
+            if item not in self._watched:
+                return
+            self.seq += 1
+            self._changes.setdefault(item, {})[path] = self.seq
+
+    def start_watching(self, item: str) -> None:
+        """
+        All changes in the tree of `item` are recorded from now on, earlier backups are no baseline.
+        Also used after events were lost, e.g. on a queue overflow.
+        """
+        with self._lock:
+            self.seq += 1
+            self._watched[item] = self.seq
+            self._changes.pop(item, None)
+            self._clean.pop(item, None)
+
+    def stop_watching(self, item: str) -> None:
+        with self._lock:
+            self._watched.pop(item, None)
+            self._changes.pop(item, None)
+            self._clean.pop(item, None)
+
+    def is_unchanged(
+        self, item: str, target: str, covers: Callable[[str], bool] | None = None
+    ) -> bool:
+        """
+        True if `target` of directory `item` has no changes since its last backup.
+        `covers` tells if a changed path belongs to the target, all paths do by default.
+        """
+        with self._lock:
+            baseline = self._clean.get(item, {}).get(target)
+            watched = self._watched.get(item)
+            if baseline is None or watched is None or baseline < watched:
+                return False
+            return not any(
+                seq > baseline and (covers is None or covers(path))
+                for path, seq in self._changes.get(item, {}).items()
+            )
+
+    def mark_backed_up(self, item: str, target: str, started_seq: int) -> None:
+        """
+        `target` was backed up successfully, by a backup started at `started_seq`.
+        """
+        with self._lock:
+            watched = self._watched.get(item)
+            if watched is None or started_seq < watched:
+                # the watch started during the backup, changes before may be missing
+                return
+            clean = self._clean.setdefault(item, {})
+            clean[target] = started_seq
+            # changes backed up by all targets are not needed anymore
+            oldest = min(clean.values())
+            changes = self._changes.get(item, {})
+            for path in [path for path, seq in changes.items() if seq <= oldest]:
+                del changes[path]
+
+    def save(self, stopped: bool = False) -> None:
+        """
+        Write the journal atomically, by the watcher. The time written tells readers it is still running,
+        `stopped` that it won't write it anymore.
+        """
+        with self._lock:
+            data = {
+                "session": self.session,
+                "saved": time.time(),
+                "stopped": stopped,
+                "depth": self.depth,
+                "seq": self.seq,
+                "watched": self._watched,
+                "changes": self._changes,
+            }
+            _write_json(self.path, data)
+
+    def save_baselines(self) -> None:
+        """
+        Write the baselines atomically, after the backups. Baselines written meanwhile by other runs
+        in the same watcher session are kept.
+        """
+        with self._lock:
+            clean = {item: dict(targets) for item, targets in self._clean.items()}
+        for item, targets in self._load_baselines().items():
+            for target, seq in targets.items():
+                clean.setdefault(item, {})
+                clean[item][target] = max(clean[item].get(target, seq), seq)
+        _write_json(self.baselines_path, {"session": self.session, "clean": clean})
+
+
+def _write_json(path: str, data: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+class ChangeWatcher:
+    """
+    Linux inotify watches on all directories below the configured directories, feeding a ChangeJournal.
+
+    inotify watches single directories, so every subdirectory needs an own watch. If the watch limit
+    (fs.inotify.max_user_watches) is reached, the directory is not watched and falls back to a scan,
+    as are all directories after an overflow of the event queue.
+    The journal is saved every `save_interval` seconds, also without changes.
+    """
+
+    def __init__(self, journal: ChangeJournal, base_dir: str, save_interval: float = 10) -> None:
+        self.journal = journal
+        self.base_dir = base_dir
+        self.save_interval = save_interval
+        self._next_save = 0.0
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self._watches: dict[int, tuple[str, str]] = {}  # wd -> (directory, path relative to it)
+        self._wanted: set[str] = set()
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="change-watcher", daemon=True)
+
+    def watch(self, directories: List[str]) -> None:
+        """
+        Set the directories to watch, their watches are added in the background.
+        Directories which couldn't be watched are tried again.
+        """
+        with self._lock:
+            self._wanted = set(directories)
+        self._changed.set()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        os.close(self._fd)
+        self._save(stopped=True)
+
+    def _save(self, stopped: bool = False) -> None:
+        try:
+            self.journal.save(stopped)
+        except OSError as e:
+            logger.warning(f"Can't write change journal {self.journal.path}: {e}")
+        self._next_save = time.monotonic() + self.save_interval
+
+    def _add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def _remove_watches(self, item: str, rel_prefix: str | None = None) -> None:
+        """
+        Remove the watches of `item`, or of the subtree `rel_prefix` of it.
+        """
+        for wd, (watched_item, rel) in list(self._watches.items()):
+            if watched_item != item:
+                continue
+            if rel_prefix is not None and rel != rel_prefix and not rel.startswith(f"{rel_prefix}/"):
+                continue
+            del self._watches[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _watch_tree(self, item: str, rel_root: str) -> bool:
+        """
+        Watch a directory and all directories below it. Each directory is watched before it is listed,
+        so subdirectories created meanwhile are reported by an event.
+        """
+        stack = [rel_root]
+        while stack:
+            if self._stop.is_set():
+                return False
+            if time.monotonic() >= self._next_save:
+                self._save()  # large trees take a while, keep the journal current for readers
+            rel = stack.pop()
+            path = os.path.join(self.base_dir, item, rel)
+            try:
+                self._watches[self._add_watch(path)] = (item, rel)
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(os.path.join(rel, entry.name))
+            except FileNotFoundError:
+                continue  # removed meanwhile, reported by an event
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.warning(
+                        f"inotify watch limit reached at {path}, {item} falls back to scanning. "
+                        "Raise fs.inotify.max_user_watches to watch it."
+                    )
+                else:
+                    logger.warning(f"Can't watch {path}, {item} falls back to scanning: {e}")
+                self._remove_watches(item)
+                self.journal.stop_watching(item)
+                return False
+        return True
+
+    def _sync_directories(self) -> None:
+        with self._lock:
+            wanted = set(self._wanted)
+        watched = {item for item, _ in self._watches.values()}
+        for item in watched - wanted:
+            self._remove_watches(item)
+            self.journal.stop_watching(item)
+        for item in sorted(wanted - watched):
+            started = time.monotonic()
+            # events are recorded from the first watch on, the baseline starts after the whole tree
+            self.journal.start_watching(item)
+            if self._watch_tree(item, ""):
+                self.journal.start_watching(item)
+                logger.info(
+                    f"Watching {item} for changes, "
+                    f"{sum(1 for watched_item, _ in self._watches.values() if watched_item == item)} "
+                    f"directories in {time.monotonic() - started:.1f}s"
+                )
+            if self._stop.is_set():
+                return
+
+    def _handle(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("inotify event queue overflowed, all directories fall back to scanning once.")
+            for item in {item for item, _ in self._watches.values()}:
+                self.journal.start_watching(item)
+            return
+        watch = self._watches.get(wd)
+        if watch is None:
+            return
+        item, rel = watch
+        if mask & IN_IGNORED:
+            del self._watches[wd]
+            return
+        if mask & (IN_UNMOUNT | IN_DELETE_SELF | IN_MOVE_SELF) and rel == "":
+            logger.warning(f"{item} was removed, moved or unmounted, stop watching it.")
+            self._remove_watches(item)
+            self.journal.stop_watching(item)
+            return
+        rel_path = os.path.join(rel, name) if name else rel
+        self.journal.record(item, rel_path)
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                # the watches of a moved directory would report the old paths
+                self._remove_watches(item, rel_path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(item, rel_path)
+
+    def _read_events(self) -> None:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            self._handle(wd, mask, name)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            if self._changed.is_set():
+                self._changed.clear()
+                self._sync_directories()
+            readable, _, _ = select.select([self._fd], [], [], 1.0)
+            if readable:
+                self._read_events()
+            if time.monotonic() >= self._next_save:
+                self._save()
@@ -0,0 +1,247 @@
+import json
+import logging
+import threading
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from fnmatch import fnmatch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# minute hour day-of-month month day-of-week, like crontab(5)
+CRON_FIELDS = [
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 7),
+]
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+}
+
+
+def _parse_cron_field(text: str, low: int, high: int) -> set[int]:
+    """
+    Values of one field: `*`, `5`, `1-5`, `*/15`, `1-5/2`, `10/5` and lists of them.
+    """
+    values = set()
+    for part in text.split(","):
+        value_range, _, step = part.partition("/")
+        if value_range == "*":
+            start, end = low, high
+        elif "-" in value_range:
+            start, end = (int(value) for value in value_range.split("-", 1))
+        else:
+            start = end = int(value_range)
+            if step:
+                end = high
+        if start < low or end > high or start > end or (step and int(step) < 1):
+            raise ValueError(f"{part} out of range {low}-{high}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+class CronSchedule:
+    """
+    A crontab(5) time specification. Day of month and day of week match either, if both are restricted.
+    Times are local times.
+    """
+
+    def __init__(self, spec: str) -> None:
+        self.spec = spec.strip()
+        fields = CRON_ALIASES.get(self.spec, self.spec).split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f"Cron schedule '{spec}' needs 5 fields: minute hour day month weekday")
+        try:
+            parsed = [
+                _parse_cron_field(text, low, high)
+                for text, (_, low, high) in zip(fields, CRON_FIELDS)
+            ]
+        except ValueError as e:
+            raise ValueError(f"Invalid cron schedule '{spec}': {e}") from e
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {day % 7 for day in weekdays}  # 0 and 7 are Sunday
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+        self.next_after(datetime(2000, 1, 1))  # e.g. 30 2 * raises here
+
+    def _day_matches(self, t: datetime) -> bool:
+        in_days = t.day in self.days
+        in_weekdays = (t.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, after: datetime) -> datetime:
+        """
+        First matching minute after `after`.
+        """
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"Cron schedule '{self.spec}' never matches")
+
+
+class DirectorySchedules:
+    """
+    Schedule of each directory: the first entry like `0 * * * *=photos-20*,scans` whose
+    patterns match the directory, the default schedule otherwise.
+    """
+
+    def __init__(self, default: str, entries: list[str]) -> None:
+        self.default = CronSchedule(default)
+        self.entries = []
+        for entry in entries:
+            spec, separator, patterns = entry.rpartition("=")
+            if not separator:
+                raise ValueError(f"Schedule '{entry}' needs the form '<cron>=<directory patterns>'")
+            self.entries.append((CronSchedule(spec), [p.strip() for p in patterns.split(",")]))
+
+    def for_directory(self, item: str) -> CronSchedule:
+        for schedule, patterns in self.entries:
+            if any(fnmatch(item, pattern) for pattern in patterns):
+                return schedule
+        return self.default
+
+
+@dataclass
+class DirectoryStatus:
+    schedule: str
+    next_run: str = ""
+    last_run: str = ""
+    last_success: bool | None = None
+    last_action: str = ""
+    last_elapsed: float = -1
+
+
+@dataclass
+class DaemonStatus:
+    """
+    State of the daemon as served by the status endpoint. Thread safe.
+    """
+
+    started: str = field(default_factory=lambda: datetime.now().isoformat(timespec="seconds"))
+    runs: int = 0
+    failed_runs: int = 0
+    running: list[str] = field(default_factory=list)
+    running_since: str = ""
+    directories: dict[str, DirectoryStatus] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def set_directories(self, next_runs: dict[str, tuple[CronSchedule, datetime]]) -> None:
+        with self._lock:
+            previous = self.directories
+            self.directories = {}
+            for item, (schedule, next_run) in next_runs.items():
+                status = previous.get(item) or DirectoryStatus(schedule.spec)
+                status.schedule = schedule.spec
+                status.next_run = next_run.isoformat(timespec="minutes")
+                self.directories[item] = status
+
+    def start_run(self, items: list[str]) -> None:
+        with self._lock:
+            self.running = list(items)
+            self.running_since = datetime.now().isoformat(timespec="seconds")
+
+    def finish_run(
+        self, items: list[str], success: bool, results: dict[str, tuple[bool, str, float]]
+    ) -> None:
+        """
+        `results` are success, action and elapsed time per directory, others get the success of the run.
+        """
+        with self._lock:
+            now = datetime.now().isoformat(timespec="seconds")
+            self.runs += 1
+            self.failed_runs += 0 if success else 1
+            for item in items:
+                status = self.directories.get(item)
+                if status is None:
+                    continue
+                status.last_run = now
+                status.last_success, status.last_action, status.last_elapsed = results.get(
+                    item, (success, "", -1)
+                )
+            self.running = []
+            self.running_since = ""
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "runs": self.runs,
+                "failed_runs": self.failed_runs,
+                "running": self.running,
+                "running_since": self.running_since,
+                "directories": {item: asdict(status) for item, status in self.directories.items()},
+            }
+
+
+class StatusServer:
+    """
+    Local HTTP endpoint of the daemon: GET /status (JSON) and /healthz for liveness probes.
+    """
+
+    def __init__(self, address: str, port: int, status: DaemonStatus) -> None:
+        daemon_status = status
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.rstrip("/") in ["", "/status"]:
+                    body = json.dumps(daemon_status.as_dict(), indent=1).encode()
+                    content_type = "application/json"
+                elif self.path == "/healthz":
+                    body, content_type = b"ok\n", "text/plain"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                logger.debug(f"status endpoint: {format % args}")
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="status-server", daemon=True
+        )
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        self._thread.start()
+        logger.info(f"Status endpoint on http://{self._server.server_address[0]}:{self.port}/status")
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def sleep_until(wake_up: datetime, stop: threading.Event) -> None:
+    """
+    Sleep until the local time `wake_up`, in short steps to follow clock changes. Returns early on `stop`.
+    """
+    while not stop.is_set():
+        seconds = (wake_up - datetime.now()).total_seconds()
+        if seconds <= 0:
+            return
+        stop.wait(min(seconds, 60))
@@ -0,0 +1,140 @@
+import logging
+import time
+from dataclasses import dataclass
+from hashlib import md5
+from typing import Iterable
+
+from history import RunHistory
+
+logger = logging.getLogger(__name__)
+
+# a chain this far beyond the limits gets its full backup regardless of its staggered night
+OVERDUE_FACTOR = 2.0
+
+
+@dataclass
+class ChainCost:
+    """
+    Measured cost of the current backup chain of a directory, from the run history.
+    """
+
+    source: str
+    full_bytes: int
+    inc_bytes: int
+    incs: int
+    restore_seconds: float
+
+    @property
+    def inc_ratio(self) -> float:
+        return self.inc_bytes / self.full_bytes if self.full_bytes > 0 else 0.0
+
+
+@dataclass
+class FullDecision:
+    full: bool
+    reason: str = ""
+
+
+class FullPolicy:
+    """
+    Decide full or incremental backup per directory from the cost of its current chain,
+    instead of a fixed number of incrementals.
+
+    A full backup is due if the incrementals add up to `max_inc_ratio` of the full backup
+    or restoring the chain is estimated to take longer than `max_restore_hours`.
+    Due fulls run on the staggered night of the directory (one of `stagger_days`, from a stable hash),
+    most urgent first, as long as their estimated size fits into `upload_budget` GB.
+    """
+
+    def __init__(
+        self,
+        history: RunHistory,
+        max_inc_ratio: float = 0.5,
+        max_restore_hours: float = 12,
+        restore_rate: float = 20,
+        inc_restore_overhead: float = 60,
+        upload_budget: float = 0,
+        stagger_days: int = 7,
+        now: float | None = None,
+    ) -> None:
+        self.history = history
+        self.max_inc_ratio = max_inc_ratio
+        self.max_restore_seconds = max_restore_hours * 3600
+        self.restore_rate = restore_rate * 1e6  # MB/s
+        self.inc_restore_overhead = inc_restore_overhead
+        self.upload_budget = upload_budget * 1e9  # GB
+        self.stagger_days = max(1, stagger_days)
+        self.day = int((now or time.time()) // 86400)
+
+    def chain_cost(self, source: str) -> ChainCost | None:
+        """
+        None if the history has no full backup of `source`, e.g. on the first runs with history.
+        """
+        full, incs = self.history.current_chain(source)
+        if full is None:
+            return None
+        full_bytes = full.destsizechange if full.destsizechange > 0 else full.sourcefilesize
+        if full_bytes <= 0:
+            return None
+        inc_bytes = sum(max(inc.destsizechange, 0) for inc in incs)
+        restore_seconds = (
+            full_bytes + inc_bytes
+        ) / self.restore_rate + self.inc_restore_overhead * len(incs)
+        return ChainCost(source, full_bytes, inc_bytes, len(incs), restore_seconds)
+
+    def urgency(self, cost: ChainCost) -> tuple[float, str]:
+        """
+        Returns how far the chain is beyond its limits (>= 1 means a full is due) and why.
+        """
+        ratio_score = cost.inc_ratio / self.max_inc_ratio if self.max_inc_ratio > 0 else 0
+        restore_score = (
+            cost.restore_seconds / self.max_restore_seconds
+            if self.max_restore_seconds > 0
+            else 0
+        )
+        if ratio_score >= restore_score:
+            return ratio_score, f"{cost.incs} incrementals are {cost.inc_ratio:.0%} of the full backup"
+        return restore_score, f"estimated restore time {cost.restore_seconds / 3600:.1f}h"
+
+    def is_stagger_night(self, source: str) -> bool:
+        slot = int(md5(source.encode()).hexdigest(), 16) % self.stagger_days
+        return self.day % self.stagger_days == slot
+
+    def plan(self, sources: Iterable[str]) -> dict[str, FullDecision | None]:
+        """
+        Decide for all directories of a run. None means no history, use the fallback (`do_full_after`).
+        """
+        sources = list(sources)
+        decisions: dict[str, FullDecision | None] = {}
+        due = []
+        for source in sources:
+            cost = self.chain_cost(source)
+            if cost is None:
+                decisions[source] = None
+                continue
+            score, reason = self.urgency(cost)
+            if score < 1:
+                decisions[source] = FullDecision(False)
+            elif score < OVERDUE_FACTOR and not self.is_stagger_night(source):
+                decisions[source] = FullDecision(
+                    False, f"full backup due ({reason}), waiting for its staggered night"
+                )
+            else:
+                due.append((score, source, cost, reason))
+
+        planned_bytes = 0
+        for score, source, cost, reason in sorted(due, reverse=True):
+            # the new full is about as large as the current chain
+            estimate = cost.full_bytes + cost.inc_bytes
+            if self.upload_budget and planned_bytes and planned_bytes + estimate > self.upload_budget:
+                decisions[source] = FullDecision(
+                    False, f"full backup due ({reason}), deferred by the upload budget"
+                )
+                continue
+            planned_bytes += estimate
+            decisions[source] = FullDecision(True, reason)
+        logger.info(
+            f"Full backups planned: {sum(1 for d in decisions.values() if d and d.full)}, "
+            f"estimated upload {planned_bytes / 1e9:.1f} GB"
+        )
+        return {source: decisions[source] for source in sources}
@@ -0,0 +1,248 @@
+import logging
+import os
+import signal
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# /proc/<pid>/io counters per resource. wchar counts all bytes written, including to sockets,
+# so it is an upper bound of the upload of duplicity and its backend processes (ssh, rsync, ...).
+RESOURCES = {"upload": "wchar", "read": "read_bytes"}
+# seconds of budget a job may save up while it is below its share
+BURST_SECONDS = 2.0
+# longest pause, keeps connections of backends (ssh, rsync) from timing out
+MAX_PAUSE_SECONDS = 10.0
+
+
+def parse_schedule(entries: list[str]) -> list[tuple[int, float]]:
+    """
+    Parse a time-of-day schedule like ["06:00=2", "22:00=0"] into (minute of day, bytes/s), sorted.
+    Rates are in MB/s, 0 means unlimited.
+    """
+    schedule = []
+    for entry in entries:
+        start, _, rate = entry.partition("=")
+        hours, _, minutes = start.strip().partition(":")
+        schedule.append((int(hours) * 60 + int(minutes or 0), float(rate) * 1e6))
+    return sorted(schedule)
+
+
+def rate_at(schedule: list[tuple[int, float]], now: datetime) -> float:
+    """
+    Rate of the last entry started before `now`, the day wraps around. 0 is unlimited.
+    """
+    if not schedule:
+        return 0
+    minute = now.hour * 60 + now.minute
+    rate = schedule[-1][1]  # before the first entry, the last one of the day before is active
+    for start, entry_rate in schedule:
+        if start <= minute:
+            rate = entry_rate
+    return rate
+
+
+def fair_shares(demands: dict[str, float], total: float) -> dict[str, float]:
+    """
+    Max-min fair split of `total`: jobs needing less than an equal share keep their demand,
+    the rest is split equally between the others. Small incrementals get what they need,
+    big full backups can't starve them.
+    """
+    shares = {}
+    left = total
+    pending = sorted(demands.items(), key=lambda item: item[1])
+    while pending:
+        equal = left / len(pending)
+        job, demand = pending[0]
+        if demand >= equal:
+            shares.update({job: equal for job, _ in pending})
+            break
+        shares[job] = demand
+        left -= demand
+        pending.pop(0)
+    return shares
+
+
+def _process_tree(pid: int) -> list[int]:
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm may contain spaces and parentheses, ppid is the 2nd field after it
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def _read_io(pid: int) -> dict[str, int]:
+    counters = {}
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+@dataclass
+class GovernedJob:
+    pid: int
+    stopped: bool = False
+    stopped_seconds: float = 0
+    started: float = field(default_factory=time.monotonic)
+    counters: dict[int, dict[str, int]] = field(default_factory=dict)  # per process of the tree
+    credit: dict[str, float] = field(default_factory=dict)
+    demand: dict[str, float] = field(default_factory=dict)
+
+
+class IOGovernor:
+    """
+    Enforce one upload and one disk read budget across all running duplicity processes.
+
+    Every `interval` the I/O of each job's process tree is read from /proc/<pid>/io. The budget of the
+    current time of day is split into fair shares and each job's usage is charged against its share.
+    A job using more than its share is paused with SIGSTOP until its share has caught up (SIGCONT),
+    a duty cycle averaging to the share. Linux only.
+    """
+
+    def __init__(
+        self,
+        upload_schedule: list[str],
+        read_schedule: list[str],
+        interval: float = 0.5,
+    ) -> None:
+        self.schedules = {
+            "upload": parse_schedule(upload_schedule),
+            "read": parse_schedule(read_schedule),
+        }
+        self.interval = interval
+        self._jobs: dict[str, GovernedJob] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __bool__(self) -> bool:
+        return any(self.schedules.values())
+
+    def start(self) -> None:
+        if not os.path.exists("/proc/self/io"):
+            logger.warning("No /proc/<pid>/io on this system, bandwidth and I/O budgets are not enforced.")
+            return
+        self._thread = threading.Thread(target=self._run, name="io-governor", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            for job in self._jobs.values():
+                self._set_stopped(job, False)
+
+    def register(self, name: str, pid: int) -> None:
+        with self._lock:
+            self._jobs[name] = GovernedJob(pid)
+
+    def unregister(self, name: str) -> None:
+        """
+        Resume the job if it is paused and log how long it was throttled.
+        """
+        with self._lock:
+            job = self._jobs.pop(name, None)
+            if job is None:
+                return
+            self._set_stopped(job, False)
+        runtime = time.monotonic() - job.started
+        if job.stopped_seconds > 0:
+            logger.info(
+                f"[{name}] throttled {job.stopped_seconds:.0f}s of {runtime:.0f}s by the I/O budget"
+            )
+
+    def _run(self) -> None:
+        last = time.monotonic()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            with self._lock:
+                self._tick(now - last)
+            last = now
+
+    def _tick(self, elapsed: float) -> None:
+        wall_clock = datetime.now()
+        usage = {name: self._measure(job) for name, job in self._jobs.items()}
+        pause = {name: False for name in self._jobs}
+        for resource, schedule in self.schedules.items():
+            total = rate_at(schedule, wall_clock)
+            if total <= 0:
+                for job in self._jobs.values():
+                    job.credit.pop(resource, None)
+                continue
+            demands = {}
+            for name, job in self._jobs.items():
+                if not job.stopped and elapsed > 0:
+                    # demand is what the job used while it was allowed to run, smoothed
+                    rate = usage[name][resource] / elapsed
+                    job.demand[resource] = 0.5 * job.demand.get(resource, rate) + 0.5 * rate
+                throttled = job.stopped or job.credit.get(resource, 0) < 0
+                if throttled or resource not in job.demand:
+                    demands[name] = total  # wants more than it gets
+                else:
+                    # headroom to grow, at least a small share to notice new demand
+                    demands[name] = max(
+                        1.2 * job.demand[resource], 0.1 * total / len(self._jobs)
+                    )
+            shares = fair_shares(demands, total)
+            for name, job in self._jobs.items():
+                share = shares[name]
+                credit = job.credit.get(resource, 0) + share * elapsed - usage[name][resource]
+                job.credit[resource] = min(
+                    max(credit, -MAX_PAUSE_SECONDS * share), BURST_SECONDS * share
+                )
+                if job.credit[resource] < 0:
+                    pause[name] = True
+        for name, job in self._jobs.items():
+            if job.stopped:
+                job.stopped_seconds += elapsed
+            self._set_stopped(job, pause[name])
+
+    def _measure(self, job: GovernedJob) -> dict[str, int]:
+        """
+        Bytes used by the process tree of `job` since the last tick.
+        """
+        used = {resource: 0 for resource in RESOURCES}
+        counters = {}
+        for pid in _process_tree(job.pid):
+            current = _read_io(pid)
+            if not current:
+                continue
+            previous = job.counters.get(pid, {})
+            for resource, counter in RESOURCES.items():
+                used[resource] += max(current.get(counter, 0) - previous.get(counter, 0), 0)
+            counters[pid] = current
+        job.counters = counters
+        return used
+
+    def _set_stopped(self, job: GovernedJob, stopped: bool) -> None:
+        # the whole tree, the upload may run in a backend child process (ssh, rsync)
+        pids = list(job.counters) or [job.pid]
+        sig = signal.SIGSTOP if stopped else signal.SIGCONT
+        if stopped == job.stopped and not stopped:
+            return
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+        job.stopped = stopped
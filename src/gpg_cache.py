@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+from hashlib import sha256
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_NAME = "dupback-gpg-state.json"
+# files of the keyring, compared by mtime and size. gpg updates the mtime of trustdb.gpg
+# on every trust check, its size only changes with the ownertrust.
+KEYRING_FILES = ["pubring.kbx", "pubring.gpg", "secring.gpg", "private-keys-v1.d"]
+SIZE_ONLY_FILES = ["trustdb.gpg"]
+
+
+def get_gnupg_home() -> str:
+    """
+    Same default as gpg: `$GNUPGHOME` or ~/.gnupg.
+    """
+    return os.path.expanduser(os.getenv("GNUPGHOME") or "~/.gnupg")
+
+
+def keyring_state(gnupg_home: str) -> dict[str, list[int]]:
+    """
+    mtime and size of the keyring files, one stat call each. Missing files are left out.
+    """
+    state = {}
+    for name in KEYRING_FILES + SIZE_ONLY_FILES:
+        try:
+            st = os.stat(os.path.join(gnupg_home, name))
+        except FileNotFoundError:
+            continue
+        state[name] = [0 if name in SIZE_ONLY_FILES else st.st_mtime_ns, st.st_size]
+    return state
+
+
+class GpgStateCache:
+    """
+    Remember a successful validation of the gpg keys, stored in the gnupg home next to the keyring.
+    Valid as long as fingerprint, the configured keys and mtime and size of the keyring files are unchanged,
+    so the gpg processes listing and importing the keys only run after the keyring or the config changed.
+    """
+
+    def __init__(self, gnupg_home: str | None = None) -> None:
+        self.gnupg_home = gnupg_home or get_gnupg_home()
+        self.path = os.path.join(self.gnupg_home, CACHE_FILE_NAME)
+
+    def _key(
+        self, fingerprint: str, public_key_pem: str | None, private_key_pem: str | None
+    ) -> str:
+        digest = sha256()
+        for part in [fingerprint, public_key_pem or "", private_key_pem or ""]:
+            digest.update(sha256(part.encode()).digest())
+        digest.update(json.dumps(keyring_state(self.gnupg_home), sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def is_valid(
+        self, fingerprint: str, public_key_pem: str | None, private_key_pem: str | None
+    ) -> bool:
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            logger.warning(f"Ignoring broken gpg state cache {self.path}: {e}")
+            return False
+        return cached.get("key") == self._key(fingerprint, public_key_pem, private_key_pem)
+
+    def store(
+        self, fingerprint: str, public_key_pem: str | None, private_key_pem: str | None
+    ) -> None:
+        """
+        Call after a successful validation, including the imports it made.
+        Failing to write, e.g. on a read only gnupg home, only costs the validation next time.
+        """
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {
+                        "key": self._key(fingerprint, public_key_pem, private_key_pem),
+                        "fingerprint": fingerprint,
+                    },
+                    f,
+                )
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Can't write gpg state cache {self.path}: {e}")
@@ -1,7 +1,32 @@
+import os
+import shlex
 import time
 import boto3
 import fnmatch
 import argparse
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from datetime import datetime, timezone
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from archive_cache import build_chains, chain_at
+
+GLACIER_STORAGE_CLASSES = {'GLACIER', 'DEEP_ARCHIVE'}
+
+# error codes S3 answers with if requests come in too fast or retrieval capacity is exhausted
+THROTTLING_ERRORS = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'ServiceUnavailable',
+    'GlacierExpeditedRetrievalNotAvailable',
+}
+
 
 def wait(seconds):
     print(f"Wait {seconds}s: ", end="")
@@ -10,61 +35,419 @@ def wait(seconds):
         time.sleep(1)
     print("")
 
-def initiate_restore(bucket_name, file_pattern, days=7, dry_run=False):
-    # Create a session using the default profile
+
+class TokenBucket:
+    """
+    Thread safe token bucket, `acquire` blocks until a token is available.
+    `rate` tokens are added per second, up to `burst` tokens.
+    Waiting callers are served first come, first served.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self._next_ticket = 0
+        self._serving = 0
+
+    def acquire(self):
+        with self._lock:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if ticket == self._serving and self._tokens >= 1:
+                    self._tokens -= 1
+                    self._serving += 1
+                    return
+                wait_time = max(0.01, (1 - self._tokens) / self.rate) if ticket == self._serving else 0.05
+            time.sleep(wait_time)
+
+
+def with_retry(func, retries=6, base_delay=2.0, **kwargs):
+    """
+    Call `func(**kwargs)`, retry with exponential backoff and jitter if S3 throttles.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(**kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in THROTTLING_ERRORS or attempt == retries:
+                raise
+            delay = base_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"Throttled ({code}) on {kwargs.get('Key')}, retry in {delay:.0f}s")
+            time.sleep(delay)
+
+
+def restore_key(s3, bucket_name, key, days, tier, dry_run, limiter):
+    """
+    Check the restore status of one object and initiate the restore if needed.
+    Returns the resulting state: ongoing, restored, initiated or dry-run.
+    DEEP_ARCHIVE does not support Expedited retrievals, these objects are requested with Standard.
+    """
+    response = with_retry(s3.head_object, Bucket=bucket_name, Key=key)
+    if 'Restore' in response:
+        restore_status = response['Restore']
+        print(f"Restore status for {key}: {restore_status}")
+        if 'ongoing-request="true"' in restore_status:
+            print(f"{key} is currently being restored.")
+            return 'ongoing'
+        print(f"{key} has been successfully restored and is now available for access.")
+        return 'restored'
+    downgraded = tier == 'Expedited' and response.get('StorageClass') == 'DEEP_ARCHIVE'
+    if downgraded:
+        tier = 'Standard'
+    if dry_run:
+        print(f"Dry run: trigger restore of {key} ({tier})")
+        return 'dry-run'
+    if not downgraded:  # the expedited capacity limit does not apply
+        limiter.acquire()
+    try:
+        response = with_retry(
+            s3.restore_object,
+            Bucket=bucket_name,
+            Key=key,
+            RestoreRequest={
+                'Days': days,
+                'GlacierJobParameters': {
+                    'Tier': tier  # Use 'Bulk' or 'Expedited' for different retrieval options
+                }
+            }
+        )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'RestoreAlreadyInProgress':
+            # requested by someone else since head_object
+            print(f"{key} is currently being restored.")
+            return 'ongoing'
+        raise
+    print(f"Restore initiated: {key}, Status: {response['ResponseMetadata']['HTTPStatusCode']}")
+    return 'initiated'
+
+
+def get_s3_client(workers=8, endpoint_url=None):
+    # clients are thread safe, allow one connection per worker
     session = boto3.Session()
-    
-    # Create an S3 client
-    s3 = session.client('s3')
-    
+    return session.client(
+        's3',
+        endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=max(10, workers)),
+    )
+
+
+def get_limiter(tier, rate=None, burst=None):
+    """
+    Without provisioned capacity, S3 grants about 3 expedited retrievals per 5 minutes.
+    Other tiers are limited by the request rate of S3 only.
+    """
+    if rate is None:
+        rate = 3 / 300 if tier == 'Expedited' else 10.0
+    if burst is None:
+        burst = 3 if tier == 'Expedited' else int(max(1, rate))
+    return TokenBucket(rate, burst)
+
+
+def restore_keys(s3, bucket_name, keys, days=7, dry_run=False, workers=8, tier='Expedited', limiter=None,
+                 failed_keys=None):
+    """
+    Initiate restores for `keys` through a pool of `workers` threads.
+    Restores are requested in the order of `keys` as far as the limiter allows.
+    Returns a Counter of the resulting states, keys which failed are added to the list `failed_keys`.
+    """
+    limiter = limiter or get_limiter(tier)
+    states = Counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(restore_key, s3, bucket_name, key, days, tier, dry_run, limiter): key
+            for key in keys
+        }
+        for future in as_completed(futures):
+            try:
+                states[future.result()] += 1
+            except ClientError as e:
+                print(f"Failed to restore {futures[future]}: {e}")
+                states['failed'] += 1
+                if failed_keys is not None:
+                    failed_keys.append(futures[future])
+    return states
+
+
+def initiate_restore(bucket_name, file_pattern, days=7, dry_run=False, workers=8, tier='Expedited',
+                     rate=None, burst=None, endpoint_url=None):
+    s3 = get_s3_client(workers, endpoint_url)
+
     # List objects in the bucket
     paginator = s3.get_paginator('list_objects_v2')
     page_iterator = paginator.paginate(Bucket=bucket_name)
 
-
-    restored_files = 0
-
+    keys = []
     for page in page_iterator:
         if 'Contents' in page:
             for obj in page['Contents']:
                 key = obj['Key']
-                if fnmatch.fnmatch(key, file_pattern) and obj['StorageClass'] == 'GLACIER':
-                    response = s3.head_object(Bucket=bucket_name, Key=key)
-                    trigger_restore = False
-                    if 'Restore' in response:
-                        restore_status = response['Restore']
-                        print(f"Restore status for {key}: {restore_status}")
-                        if 'ongoing-request="true"' in restore_status:
-                            print(f"{key} is currently being restored.")
-                        elif 'ongoing-request="false"' in restore_status:
-                            print(f"{key} has been successfully restored and is now available for access.")
-                    else:
-                        trigger_restore = True
-                        restored_files += 1
-                    if not dry_run and trigger_restore:
-                        response = s3.restore_object(
-                            Bucket=bucket_name,
-                            Key=key,
-                            RestoreRequest={
-                                'Days': days,
-                                'GlacierJobParameters': {
-                                    'Tier': 'Expedited'  # Use 'Bulk' or 'Expedited' for different retrieval options
-                                }
-                            }
-                        )
-                        print(f"Restore initiated: {key}, Status: {response['ResponseMetadata']['HTTPStatusCode']}")
-                    elif dry_run:
-                        print(f"Dry run: trigger restore of {key}")
-                    if restored_files % 3 == 0 and restored_files > 0:
-                        wait(300)
+                if fnmatch.fnmatch(key, file_pattern) and obj['StorageClass'] in GLACIER_STORAGE_CLASSES:
+                    keys.append(key)
+
+    states = restore_keys(s3, bucket_name, keys, days, dry_run, workers, tier, get_limiter(tier, rate, burst))
+    print(f"{len(keys)} objects in GLACIER matching {file_pattern}: {dict(states)}")
+    return states
+
+
+def parse_time(value):
+    """
+    Convert `now`, an ISO 8601 date/time or a duplicity time string to a duplicity time string (UTC).
+    """
+    if value == 'now':
+        when = datetime.now(timezone.utc)
+    elif len(value) == 16 and value.endswith('Z') and value[8] == 'T':
+        return value  # already 20240101T010203Z
+    else:
+        when = datetime.fromisoformat(value)
+        if when.tzinfo is None:
+            when = when.astimezone()  # local time, like duplicity
+    return when.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def list_target(s3, bucket_name, prefix):
+    """
+    Storage class by key of all objects directly inside the duplicity target `prefix`.
+    """
+    prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+    objects = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj.get('StorageClass', 'STANDARD')
+    return prefix, objects
+
+
+def get_chain_files(objects, prefix, timestring):
+    """
+    Keys of the files duplicity needs to restore the target as of `timestring`, in restore order:
+    manifests and signatures of the chain first, then the volumes of the full backup and of each incremental.
+    Returns (chain, keys), chain is None if no full backup exists before `timestring`.
+    """
+    names = [key[len(prefix):] for key in objects]
+    chain = chain_at(build_chains(names), timestring)
+    if chain is None:
+        return None, []
+    keys = [
+        prefix + name
+        for backup_set in chain.sets
+        for name in [backup_set.manifest, backup_set.signature]
+        if name
+    ]
+    keys += [
+        prefix + backup_set.volumes[volume]
+        for backup_set in chain.sets
+        for volume in sorted(backup_set.volumes)
+    ]
+    return chain, keys
+
+
+def initiate_chain_restore(bucket_name, prefix, timestring, days=7, dry_run=False, workers=8, tier='Expedited',
+                           rate=None, burst=None, endpoint_url=None):
+    """
+    Initiate restores only for the files of the backup chain needed to restore `prefix` as of `timestring`.
+    The chain is found by the file names. Volumes are in Glacier with `--s3-use-glacier`,
+    manifests and signatures too if a bucket lifecycle rule moved them, so all files of the chain are checked.
+    """
+    s3 = get_s3_client(workers, endpoint_url)
+    prefix, objects = list_target(s3, bucket_name, prefix)
+    chain, keys = get_chain_files(objects, prefix, timestring)
+    if chain is None:
+        print(f"No full backup found in s3://{bucket_name}/{prefix} before {timestring}")
+        return Counter()
+    print(
+        f"Chain for {timestring}: full {chain.full.end} + {len(chain.incs)} incrementals "
+        f"({chain.incs[-1].end if chain.incs else chain.full.end}), {len(keys)} files"
+    )
+    glacier_keys = [key for key in keys if objects[key] in GLACIER_STORAGE_CLASSES]
+    states = restore_keys(s3, bucket_name, glacier_keys, days, dry_run, workers, tier, get_limiter(tier, rate, burst))
+    print(f"{len(glacier_keys)} of {len(keys)} files in GLACIER: {dict(states)}")
+    return states
+
+
+def is_thawed(obj):
+    """
+    True if a list_objects_v2 entry, listed with OptionalObjectAttributes=['RestoreStatus'], can be read,
+    None if the listing carries no restore status for a Glacier object.
+    """
+    if obj.get('StorageClass', 'STANDARD') not in GLACIER_STORAGE_CLASSES:
+        return True
+    restore_status = obj.get('RestoreStatus')
+    if restore_status is None:
+        return None
+    return not restore_status.get('IsRestoreInProgress', True)
+
+
+def get_thawed_keys(s3, bucket_name, prefix, keys, executor):
+    """
+    Returns the subset of `keys` which can be read now, and the keys without any restore request.
+    One listing with restore status covers up to 1000 keys; head_object is only used
+    for Glacier objects the listing has no restore status for.
+    """
+    thawed, unknown = set(), []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/',
+                                   OptionalObjectAttributes=['RestoreStatus']):
+        for obj in page.get('Contents', []):
+            if obj['Key'] not in keys:
+                continue
+            state = is_thawed(obj)
+            if state is None:
+                unknown.append(obj['Key'])
+            elif state:
+                thawed.add(obj['Key'])
+
+    def head(key):
+        return key, with_retry(s3.head_object, Bucket=bucket_name, Key=key).get('Restore')
+
+    not_requested = []
+    for key, restore_status in executor.map(head, unknown):
+        if restore_status is None:
+            not_requested.append(key)
+        elif 'ongoing-request="false"' in restore_status:
+            thawed.add(key)
+    return thawed, not_requested
+
+
+def run_duplicity_restore(url, target_dir, timestring, duplicity_args):
+    import sh  # only needed for pipelined restores
+
+    os.makedirs(os.path.dirname(target_dir.rstrip('/')) or '.', exist_ok=True)
+    args = ['restore', '--time', timestring, *duplicity_args, url, target_dir]
+    print(f"Running: duplicity {' '.join(args)}")
+    sh.Command('duplicity')(args, _out=lambda line: print(line, end=''), _err_to_out=True)
+    return target_dir
+
+
+def pipelined_restore(bucket_name, prefixes, timestring, restore_to, days=7, workers=8, tier='Expedited',
+                      rate=None, burst=None, endpoint_url=None, poll_interval=300, parallel_restores=2,
+                      url_prefix='s3:///', duplicity_args=(), dry_run=False, max_attempts=3, timeout=72):
+    """
+    Initiate restores for the backup chains of all `prefixes`, poll their thaw state in batches and
+    start `duplicity restore` for a directory as soon as all files of its chain can be read.
+    Directories are restored to `restore_to`/<prefix> while others are still thawing.
+    A directory fails if a restore request of one of its files failed `max_attempts` times,
+    or if it is not available after `timeout` hours. With `dry_run`, stops after listing the chains.
+    Returns the prefixes by result: restored, failed or missing (no chain found).
+    """
+    s3 = get_s3_client(workers, endpoint_url)
+    limiter = get_limiter(tier, rate, burst)
+    results = {'restored': [], 'failed': [], 'missing': []}
+    pending = {}
+    attempts = {}  # prefix -> failed restore requests per key
+    for prefix in prefixes:
+        prefix, objects = list_target(s3, bucket_name, prefix)
+        chain, keys = get_chain_files(objects, prefix, timestring)
+        if chain is None:
+            print(f"No full backup found in s3://{bucket_name}/{prefix} before {timestring}")
+            results['missing'].append(prefix)
+            continue
+        glacier_keys = [key for key in keys if objects[key] in GLACIER_STORAGE_CLASSES]
+        failed_keys = []
+        restore_keys(s3, bucket_name, glacier_keys, days, dry_run, workers, tier, limiter, failed_keys)
+        pending[prefix] = set(keys)
+        attempts[prefix] = Counter(failed_keys)
+    if dry_run:
+        print(f"Dry run: would restore {len(pending)} directories to {restore_to}")
+        return results
+
+    deadline = time.monotonic() + timeout * 3600
+    restores = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as head_executor, \
+            ThreadPoolExecutor(max_workers=max(1, parallel_restores)) as restore_executor:
+        while pending:
+            for prefix in list(pending):
+                thawed, not_requested = get_thawed_keys(s3, bucket_name, prefix, pending[prefix], head_executor)
+                if not_requested:  # e.g. a restore expired or failed to start
+                    failed_keys = []
+                    restore_keys(s3, bucket_name, not_requested, days, False, workers, tier, limiter, failed_keys)
+                    attempts[prefix].update(failed_keys)
+                given_up = [key for key, count in attempts[prefix].items() if count >= max_attempts]
+                if given_up:
+                    print(f"{prefix}: restore of {len(given_up)} files failed {max_attempts} times, e.g. {given_up[0]}")
+                    del pending[prefix]
+                    results['failed'].append(prefix)
+                    continue
+                remaining = pending[prefix] - thawed
+                if remaining:
+                    print(f"{prefix}: {len(pending[prefix]) - len(remaining)} of {len(pending[prefix])} files available")
+                    continue
+                del pending[prefix]
+                target_dir = os.path.join(restore_to, prefix)
+                restores[restore_executor.submit(
+                    run_duplicity_restore, f"{url_prefix}{bucket_name}/{prefix.rstrip('/')}",
+                    target_dir, timestring, list(duplicity_args))] = prefix
+            if pending and time.monotonic() >= deadline:
+                print(f"Not available after {timeout}h: {sorted(pending)}")
+                results['failed'].extend(pending)
+                pending = {}
+            if pending:
+                wait(poll_interval)
+        for future in as_completed(restores):
+            prefix = restores[future]
+            try:
+                print(f"Restored {prefix} to {future.result()}")
+                results['restored'].append(prefix)
+            except Exception as e:
+                print(f"Restore of {prefix} failed: {e}")
+                results['failed'].append(prefix)
+    print(f"Pipelined restore finished: { {state: len(p) for state, p in results.items()} }")
+    return results
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Initiate restore on S3 Glacier Flexible Retrieval by file pattern.')
     parser.add_argument('bucket_name', type=str, help='The name of the S3 bucket.')
-    parser.add_argument('file_pattern', type=str, help='The file pattern to match (e.g., "*.txt").')
+    parser.add_argument('file_pattern', type=str, nargs='?', default=None,
+                        help='The file pattern to match (e.g., "*.txt"). Not used with --prefix.')
+    parser.add_argument('--prefix', type=str, action='append', default=None,
+                        help='Restore only the volumes needed to restore this duplicity target (key prefix in the bucket). '
+                             'Can be given multiple times.')
+    parser.add_argument('--time', type=str, default='now',
+                        help='Point in time to restore with --prefix, like duplicity --time: now, ISO date/time or 20240101T010203Z.')
     parser.add_argument('--days', type=int, default=7, help='The number of days to keep the restored files available.')
     parser.add_argument('--dry-run', action="store_true", help='show what would happen')
-    
+    parser.add_argument('--tier', type=str, default='Expedited', choices=['Expedited', 'Standard', 'Bulk'],
+                        help='Glacier retrieval tier.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent requests.')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Restore requests per second. Default: 3 per 5 minutes for Expedited, 10/s otherwise.')
+    parser.add_argument('--burst', type=int, default=None, help='Restore requests allowed at once before --rate applies.')
+    parser.add_argument('--endpoint-url', type=str, default=None,
+                        help='S3 endpoint, e.g. a local S3 stand-in like moto for testing.')
+    parser.add_argument('--restore-to', type=str, default=None,
+                        help='With --prefix: wait for the volumes to thaw and run `duplicity restore` for each prefix '
+                             'into this directory as soon as its chain is available.')
+    parser.add_argument('--poll-interval', type=int, default=300, help='Seconds between thaw status checks.')
+    parser.add_argument('--parallel-restores', type=int, default=2, help='duplicity restores running at the same time.')
+    parser.add_argument('--timeout', type=float, default=72,
+                        help='Hours to wait with --restore-to until a directory is available, then it fails.')
+    parser.add_argument('--url-prefix', type=str, default='s3:///',
+                        help='duplicity URL of the bucket is <url-prefix><bucket_name>/<prefix>.')
+    parser.add_argument('--duplicity-args', type=str, default='',
+                        help='Extra args for duplicity restore, e.g. "--s3-endpoint-url http://localhost:5000".')
+
     args = parser.parse_args()
-    
-    initiate_restore(args.bucket_name, args.file_pattern, args.days, args.dry_run)
+
+    if args.prefix is not None and args.restore_to is not None:
+        pipelined_restore(args.bucket_name, args.prefix, parse_time(args.time), args.restore_to, args.days,
+                          args.workers, args.tier, args.rate, args.burst, args.endpoint_url, args.poll_interval,
+                          args.parallel_restores, args.url_prefix, shlex.split(args.duplicity_args), args.dry_run,
+                          timeout=args.timeout)
+    elif args.prefix is not None:
+        for prefix in args.prefix:
+            initiate_chain_restore(args.bucket_name, prefix, parse_time(args.time), args.days, args.dry_run,
+                                   args.workers, args.tier, args.rate, args.burst, args.endpoint_url)
+    elif args.file_pattern is None:
+        parser.error('either file_pattern or --prefix is required')
+    else:
+        initiate_restore(args.bucket_name, args.file_pattern, args.days, args.dry_run, args.workers, args.tier,
+                         args.rate, args.burst, args.endpoint_url)
@@ -0,0 +1,177 @@
+import logging
+import os
+import statistics
+import time
+from dataclasses import dataclass, fields
+from typing import Iterable
+
+from result_reader import BackupStat
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE_NAME = "dupback-history.sqlite"
+
+_COLUMN_TYPES = {int: "INTEGER", float: "REAL", str: "TEXT"}
+_STAT_FIELDS = [field.name for field in fields(BackupStat)]
+
+
+@dataclass
+class Metric:
+    name: str  # BackupStat field or property
+    label: str
+    unit: str = ""
+
+
+# metrics checked against the baseline of a directory
+ANOMALY_METRICS = [
+    Metric("elapsedtime", "elapsed time", "s"),
+    Metric("rawdeltasize", "delta size", "B"),
+    Metric("throughput", "throughput", "B/s"),
+]
+
+
+def _to_stat(row: tuple) -> BackupStat:
+    return BackupStat(**{k: v for k, v in zip(_STAT_FIELDS, row) if v is not None})
+
+
+def robust_z_score(value: float, baseline: list[float]) -> float:
+    """
+    Distance of `value` from the median of `baseline` in units of the median absolute deviation,
+    scaled to be comparable to a standard z-score. Outliers in the baseline hardly move it.
+    The deviation is at least 5% of the median, so constant baselines don't flag tiny changes.
+    """
+    median = statistics.median(baseline)
+    mad = statistics.median(abs(x - median) for x in baseline)
+    mad = max(mad, 0.05 * abs(median), 1e-9)
+    return 0.6745 * (value - median) / mad
+
+
+class RunHistory:
+    """
+    Append-only store of the BackupStat of every run, a SQLite database next to the duplicity archive dir.
+    """
+
+    def __init__(self, archive_dir: str) -> None:
+        self.path = os.path.join(archive_dir, HISTORY_FILE_NAME)
+        os.makedirs(archive_dir, exist_ok=True)
+        import sqlite3
+
+        self._db = sqlite3.connect(self.path)
+        self._create_schema()
+
+    def _create_schema(self) -> None:
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS stats (run_ts REAL NOT NULL, run_success INTEGER NOT NULL, source TEXT NOT NULL)"
+        )
+        known = {row[1] for row in self._db.execute("PRAGMA table_info(stats)")}
+        # BackupStat may gain fields, add them to existing databases
+        for field in fields(BackupStat):
+            if field.name not in known:
+                column_type = _COLUMN_TYPES.get(field.type, "")  # type: ignore
+                self._db.execute(f"ALTER TABLE stats ADD COLUMN {field.name} {column_type}")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS stats_source_ts ON stats (source, run_ts)"
+        )
+        self._db.commit()
+
+    def record(
+        self, stats: Iterable[BackupStat], success: bool, run_ts: float | None = None
+    ) -> None:
+        run_ts = run_ts or time.time()
+        columns = ", ".join(["run_ts", "run_success", *_STAT_FIELDS])
+        placeholders = ", ".join("?" * (len(_STAT_FIELDS) + 2))
+        rows = [
+            (run_ts, int(success), *(getattr(stat, name) for name in _STAT_FIELDS))
+            for stat in stats
+        ]
+        with self._db:
+            self._db.executemany(
+                f"INSERT INTO stats ({columns}) VALUES ({placeholders})", rows
+            )
+
+    def query(
+        self,
+        source: str,
+        since: float | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+        action: str | None = None,
+    ) -> list[BackupStat]:
+        """
+        Stats of `source` between `since` and `until` (unix time), newest first.
+        Only those of `action` (full, inc, ...) if given.
+        """
+        sql = f"SELECT {', '.join(_STAT_FIELDS)} FROM stats WHERE source = ?"
+        params: list = [source]
+        if action is not None:
+            sql += " AND action = ?"
+            params.append(action)
+        if since is not None:
+            sql += " AND run_ts >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND run_ts < ?"
+            params.append(until)
+        sql += " ORDER BY run_ts DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [_to_stat(row) for row in self._db.execute(sql, params)]
+
+    def current_chain(self, source: str) -> tuple[BackupStat | None, list[BackupStat]]:
+        """
+        Stats of the current backup chain of `source`: the last full backup and the incrementals after it,
+        oldest first. The full is None if the history does not reach back to it.
+        """
+        incs = []
+        cursor = self._db.execute(
+            f"SELECT {', '.join(_STAT_FIELDS)} FROM stats WHERE source = ? AND errors <= 0 ORDER BY run_ts DESC",
+            [source],
+        )
+        for row in cursor:
+            stat = _to_stat(row)
+            if stat.action == "full":
+                return stat, incs[::-1]
+            incs.append(stat)
+        return None, incs[::-1]
+
+    def find_anomalies(
+        self,
+        stats: Iterable[BackupStat],
+        threshold: float = 3.5,
+        window: int = 30,
+        min_runs: int = 5,
+    ) -> list[str]:
+        """
+        Compare `stats` with the last `window` successful runs of the same directory and action:
+        full backups take much longer and upload much more than incrementals, mixing them
+        would flag every full backup and widen the baseline of the incrementals.
+        Returns a message per value with a robust z-score above `threshold`.
+        Directories with less than `min_runs` runs of the action have no baseline yet.
+        """
+        anomalies = []
+        for stat in stats:
+            history = [
+                past
+                for past in self.query(stat.source, limit=window, action=stat.action)
+                if past.errors <= 0
+            ]
+            for metric in ANOMALY_METRICS:
+                value = getattr(stat, metric.name)
+                baseline = [
+                    v for past in history if (v := getattr(past, metric.name)) >= 0
+                ]
+                if value < 0 or len(baseline) < min_runs:
+                    continue
+                score = robust_z_score(value, baseline)
+                if abs(score) > threshold:
+                    direction = "above" if score > 0 else "below"
+                    anomalies.append(
+                        f"{stat.source}: {metric.label} {value:.2f} {metric.unit} is far {direction} "
+                        f"its baseline (median {statistics.median(baseline):.2f} {metric.unit}, "
+                        f"{len(baseline)} {stat.action or 'other'} runs, score {score:.1f})"
+                    )
+        return anomalies
+
+    def close(self) -> None:
+        self._db.close()
@@ -1,8 +1,12 @@
 # Configure logging
+import json
 import logging
+import os
+import time
+from hashlib import sha256
 from pathlib import Path
 from kubernetes import client, config
-from typing import List, Dict, Any
+from typing import List, Dict, Tuple
 from pprint import pprint as print
 
 logging.basicConfig(
@@ -12,12 +16,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+SKIP_LABEL = "dupdir-skip-backup"
+# only pods bound to a node and not terminated can tell where a claim is used
+POD_FIELD_SELECTOR = "spec.nodeName!=,status.phase!=Succeeded,status.phase!=Failed"
+POD_PAGE_SIZE = 500
+# list names and resourceVersions only, not the whole objects
+METADATA_ONLY = {"Accept": "application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1"}
+
 
 class K8sLocalStorageDiscovery:
-    def __init__(self, storage_class_names: List[str] = ["local-storage"]):
+    def __init__(
+        self,
+        storage_class_names: List[str] = ["local-storage"],
+        cache_file: str | None = None,
+        cache_max_age: int = 7 * 24 * 3600,
+    ):
         """
         Initializes the Kubernetes CoreV1Api client.
         Tries to load in-cluster configuration, falls back to kubeconfig if needed.
+
+        Args:
+            storage_class_names (List[str]): storage classes of local storage PVs
+            cache_file (str | None): file to keep discovery results between runs, disabled if None
+            cache_max_age (int): seconds after which the cache is rebuilt even without changes
         """
         try:
             config.load_incluster_config()
@@ -29,6 +50,11 @@ class K8sLocalStorageDiscovery:
             logger.exception("Loaded kubeconfig file for Kubernetes configuration")
         self.storage_class_names = storage_class_names
         self.v1 = client.CoreV1Api()
+        self.pvc_index: Dict[Tuple[str, str], Dict[str, str]] | None = None
+        self.pvc2node: Dict[str, str] | None = None
+        self.cache_file = cache_file
+        self.cache_max_age = cache_max_age
+        self._cacheable = True
 
     def get_local_storage_dirs_for_node(self, node: str) -> List[str]:
         """
@@ -68,30 +94,43 @@ class K8sLocalStorageDiscovery:
             )
             return True
 
+        pvc_labels = self._get_pvc_index().get((claim_ref.namespace, claim_ref.name))
+        if pvc_labels is not None and SKIP_LABEL in pvc_labels:
+            logging.info(
+                f"Skipping PersistentVolume {pv.metadata.name} because its associated PVC "
+                f"'{claim_ref.namespace}/{claim_ref.name}' has the '{SKIP_LABEL}' label."
+            )
+            return True
+        return False
+
+    def _get_pvc_index(self) -> Dict[Tuple[str, str], Dict[str, str]]:
+        """
+        Labels of all PersistentVolumeClaims carrying the skip label, keyed by (namespace, name).
+        Fetched once with a single list call and a label selector.
+        This is fail open, if the list call fails, no PVC is skipped.
+
+        Returns:
+            Dict[Tuple[str, str], Dict[str, str]]: labels by (namespace, name) of the PVC
+        """
+        if self.pvc_index is not None:
+            return self.pvc_index
+        self.pvc_index = {}
         try:
-            pvc: client.V1PersistentVolumeClaim = self.v1.read_namespaced_persistent_volume_claim(
-                name=claim_ref.name,
-                namespace=claim_ref.namespace
-            ) # type: ignore
-            if not pvc or not pvc.metadata:
-                logging.warning(
-                    f"Could not retrieve PVC {claim_ref.namespace}/{claim_ref.name} for PV {pv.metadata.name}. Skipping."
-                )
-                return False
-            labels = pvc.metadata.labels or {}
-            if "dupdir-skip-backup" in labels:
-                logging.info(
-                    f"Skipping PersistentVolume {pv.metadata.name} because its associated PVC "
-                    f"'{pvc.metadata.namespace}/{pvc.metadata.name}' has the 'dupdir-skip-backup' label."
-                )
-                return True
+            pvc_list = self.v1.list_persistent_volume_claim_for_all_namespaces(
+                label_selector=SKIP_LABEL
+            )
         except client.ApiException as e:
-            logging.error(
-                f"Failed to retrieve PVC {claim_ref.namespace}/{claim_ref.name} for PV {pv.metadata.name}: {e}"
+            logging.error(f"Failed to list PersistentVolumeClaims with label {SKIP_LABEL}: {e}")
+            self._cacheable = False
+            return self.pvc_index
+        for pvc in pvc_list.items:
+            if not pvc.metadata:
+                continue
+            self.pvc_index[(pvc.metadata.namespace, pvc.metadata.name)] = (
+                pvc.metadata.labels or {}
             )
-            return False # On error, do not skip the PV
-            
-        return False
+        logger.debug(f"PersistentVolumeClaims labeled {SKIP_LABEL}: {list(self.pvc_index)}")
+        return self.pvc_index
 
     def get_node_by_pvc(self, pvc_name: str) -> str | None:
         """
@@ -102,67 +141,177 @@ class K8sLocalStorageDiscovery:
         Returns:
             str | None: The name of the node if found, otherwise None.
         """
-
-        def _get_pvc2node_cache(self, pods) -> Dict[str, str]:
-            pvc2node = {}
-            for pod in pods.items:
-                try:
-                    if not pod.spec:
-                        continue
-                    # Check all volumes in the pod for a PVC matching the claim name
-                    volumes = pod.spec.volumes or []
-                    found = False
-                    for vol in volumes:
-                        pvc_vol = getattr(vol, "persistent_volume_claim", None)
-                        if not pvc_vol:
-                            continue
-                        # In the Python Kubernetes client the attribute is `claim_name`
-                        claim_name = getattr(pvc_vol, "claim_name", None)
-                        node_name = getattr(pod.spec, "node_name", None)
-                        pod_name = pod.metadata.name if pod.metadata else "<unknown>"
-                        if node_name:
-                            logger.info(f"PVC {pvc_name} is used by pod {pod_name} on node {node_name}")
-                            pvc2node[claim_name] = node_name
-                        else:
-                            logger.info(f"PVC {pvc_name} is used by pod {pod_name} but the pod is not scheduled to a node yet")
-                except Exception as e:
-                    logger.error(f"Error while inspecting pod {getattr(pod.metadata, 'name', '<unknown>')}: {e}")
-                    continue
-            return pvc2node
-
         logger.debug(f"Retrieving node for PVC: {pvc_name}")
-        # The API server does not support a field selector for spec.volumes.persistentVolumeClaim.claimName,
-        # so retrieve all pods and filter client-side.
-        if not hasattr(self, "pods") or not self.pods:
-            self.pods = self.v1.list_pod_for_all_namespaces()
-        if not hasattr(self, "pvc2node") or not self.pvc2node:
-            self.pvc2node = _get_pvc2node_cache(self, self.pods)
+        if self.pvc2node is None:
+            self.pvc2node = self._list_pvc2node()
         node_name = self.pvc2node.get(pvc_name)
         if node_name:
             return node_name
         logger.warning(f"No pod found using PVC {pvc_name}")
         return None
 
+    def _list_pvc2node(self) -> Dict[str, str]:
+        """
+        Maps claim names to the node of the pod using the claim.
+        The API server does not support a field selector for spec.volumes.persistentVolumeClaim.claimName,
+        so all scheduled, not terminated pods are listed page by page and filtered client-side.
+        Pages are read as raw JSON, only claim name and node name are extracted.
+
+        Returns:
+            Dict[str, str]: node name by claim name
+        """
+        pvc2node: Dict[str, str] = {}
+        _continue = None
+        while True:
+            try:
+                response = self.v1.list_pod_for_all_namespaces(
+                    field_selector=POD_FIELD_SELECTOR,
+                    limit=POD_PAGE_SIZE,
+                    _continue=_continue,
+                    _preload_content=False,
+                )
+            except client.ApiException as e:
+                if e.status == 410 and _continue:
+                    # continue token expired, start over with a fresh snapshot
+                    logger.warning("Pod list changed too much while paging, restarting")
+                    pvc2node = {}
+                    _continue = None
+                    continue
+                raise
+            pod_list = json.loads(response.data)
+            for pod in pod_list.get("items") or []:
+                spec = pod.get("spec") or {}
+                node_name = spec.get("nodeName")
+                for volume in spec.get("volumes") or []:
+                    claim_name = (volume.get("persistentVolumeClaim") or {}).get("claimName")
+                    if claim_name and node_name:
+                        logger.debug(
+                            f"PVC {claim_name} is used by pod {pod.get('metadata', {}).get('name', '<unknown>')} on node {node_name}"
+                        )
+                        pvc2node[claim_name] = node_name
+            metadata = pod_list.get("metadata") or {}
+            _continue = metadata.get("continue")
+            if not _continue:
+                break
+        return pvc2node
 
     def list_local_storage_dirs_by_node(self) -> Dict[str, List[str]]:
         """
         Lists all PersistentVolumes with StorageClass configured storage classes, extracts their paths,
         and groups them by node based on node affinity.
+        With a `cache_file` the result of the last run is reused, if no PV and no skip labeled PVC
+        changed since.
 
         Returns:
             Dict[str, List[str]]: Dictionary mapping node names to lists of directory paths.
         """
+        state_digest = None
+        if self.cache_file:
+            state_digest = self._state_digest()
+            cached = self._load_cache(state_digest)
+            if cached is not None:
+                return cached
+        node_dirs = self._discover_local_storage_dirs_by_node()
+        if state_digest and self._cacheable:
+            self._save_cache(node_dirs, state_digest)
+        return node_dirs
+
+    def _state_digest(self) -> str | None:
+        """
+        Digest of the resourceVersions of all PVs and of the PVCs carrying the skip label.
+        Every change of one of these objects changes their resourceVersion, unlike the resourceVersion
+        of a list, a digest of the current objects stays comparable between nightly runs.
+        Read from metadata-only lists, the cheapest list calls.
+
+        Returns:
+            str | None: the digest, None if a list call failed
+        """
+        digest = sha256()
+        lists = [
+            ("pv", self.v1.list_persistent_volume, {}),
+            (
+                "pvc",
+                self.v1.list_persistent_volume_claim_for_all_namespaces,
+                {"label_selector": SKIP_LABEL},
+            ),
+        ]
+        for kind, list_func, kwargs in lists:
+            try:
+                response = list_func(_preload_content=False, _headers=METADATA_ONLY, **kwargs)
+            except client.ApiException as e:
+                logger.warning(f"Can't check discovery cache, listing {kind} metadata failed: {e.reason}")
+                return None
+            items = [
+                (
+                    item["metadata"].get("namespace", ""),
+                    item["metadata"]["name"],
+                    item["metadata"]["resourceVersion"],
+                )
+                for item in json.loads(response.data).get("items") or []
+            ]
+            for namespace, name, resource_version in sorted(items):
+                digest.update(f"{kind}\0{namespace}\0{name}\0{resource_version}\n".encode())
+        return digest.hexdigest()
+
+    def _load_cache(self, state_digest: str | None) -> Dict[str, List[str]] | None:
+        """
+        Returns the cached node directories if they are still valid, None otherwise.
+        Valid while the PVs and skip labeled PVCs are unchanged, `state_digest` is their current digest.
+        """
+        if not state_digest:
+            return None
+        try:
+            with open(self.cache_file) as f:  # type: ignore
+                cache = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f"Ignoring broken discovery cache {self.cache_file}: {e}")
+            return None
+        if cache.get("storage_class_names") != self.storage_class_names:
+            logger.info("Storage classes changed, discovery cache is invalid")
+            return None
+        if time.time() - cache.get("created", 0) > self.cache_max_age:
+            logger.info("Discovery cache expired")
+            return None
+        if cache.get("state_digest") != state_digest:
+            logger.info("PersistentVolumes or PersistentVolumeClaims changed, discovery cache is invalid")
+            return None
+        logger.info(f"Reusing discovery results from {self.cache_file}")
+        return cache["node_dirs"]
+
+    def _save_cache(self, node_dirs: Dict[str, List[str]], state_digest: str) -> None:
+        cache = {
+            "created": time.time(),
+            "storage_class_names": self.storage_class_names,
+            "state_digest": state_digest,
+            "node_dirs": node_dirs,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)  # type: ignore
+            tmp_file = f"{self.cache_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(cache, f, indent=1)
+            os.replace(tmp_file, self.cache_file)  # type: ignore
+        except OSError as e:
+            logger.warning(f"Can't write discovery cache {self.cache_file}: {e}")
+
+    def _discover_local_storage_dirs_by_node(self) -> Dict[str, List[str]]:
         logger.info(
             f"Listing all PersistentVolumes with StorageClass {self.storage_class_names} and grouping by node"
         )
         pv_list = self.v1.list_persistent_volume()
+        # fetch skip labels of PVCs and the nodes using them once per listing
+        self.pvc_index = None
+        self.pvc2node = None
+        self._cacheable = True
         node_dirs = {}
         for pv in pv_list.items:
             sc = pv.spec.storage_class_name
             if sc in self.storage_class_names and pv.status.phase == "Bound":
                 # Check for the "dubdir-skipp-backup" label
                 labels = pv.metadata.labels or {}
-                if "dupdir-skip-backup" in labels:
+                if SKIP_LABEL in labels:
                     logger.info(
                         f"Skipping PersistentVolume {pv.metadata.name} due to 'dubdir-skipp-backup' label."
                     )
@@ -181,15 +330,19 @@ class K8sLocalStorageDiscovery:
                     continue  # Skip this PV and move to the next one
                 node_name = self.get_node_by_pvc(pv.spec.claim_ref.name) if pv.spec.claim_ref else None
 
-                if not node_name:
-                    # Discover node affinity from required terms
-                    if pv.spec.node_affinity and pv.spec.node_affinity.required:
-                        for term in pv.spec.node_affinity.required.node_selector_terms:
-                            for expr in term.match_expressions:
-                                if expr.key == "kubernetes.io/hostname" and expr.values:
-                                    node_name = expr.values[0]
-                                    logger.debug(
-                                        f"Discovered node affinity for PV {pv.metadata.name}: {node_name}")
+                # Discover node affinity from required terms
+                affinity_node = None
+                if pv.spec.node_affinity and pv.spec.node_affinity.required:
+                    for term in pv.spec.node_affinity.required.node_selector_terms:
+                        for expr in term.match_expressions:
+                            if expr.key == "kubernetes.io/hostname" and expr.values:
+                                affinity_node = expr.values[0]
+                                logger.debug(
+                                    f"Discovered node affinity for PV {pv.metadata.name}: {affinity_node}")
+                if node_name and not affinity_node:
+                    # only the pod tells the node, pods moving are not covered by the cache check
+                    self._cacheable = False
+                node_name = node_name or affinity_node
                 if path and node_name:
                     node_dirs.setdefault(node_name, []).append(path)
                 else:
@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Iterable
+from urllib.parse import quote
+
+from result_reader import BackupStat
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "dupback"
+# seconds, from small incrementals up to full backups of large directories
+DURATION_BUCKETS = (10, 30, 60, 300, 900, 1800, 3600, 7200, 14400, 28800)
+STATE_FILE_NAME = "dupback-metrics-state.json"
+
+
+@dataclass
+class Gauge:
+    name: str
+    help: str
+    field: str  # BackupStat field or property
+
+
+GAUGES = [
+    Gauge("backup_elapsed_seconds", "Duration of the last duplicity run.", "elapsedtime"),
+    Gauge("backup_source_bytes", "Bytes read from the source directory.", "sourcefilesize"),
+    Gauge("backup_written_bytes", "Change of the destination size, bytes uploaded.", "destsizechange"),
+    Gauge("backup_source_files", "Files in the source directory.", "sourcefiles"),
+    Gauge("backup_new_files", "New files in the last backup.", "newfiles"),
+    Gauge("backup_new_file_bytes", "Size of the new files in the last backup.", "newfilesize"),
+    Gauge("backup_changed_files", "Changed files in the last backup.", "changedfiles"),
+    Gauge("backup_changed_file_bytes", "Size of the changed files in the last backup.", "changedfilesize"),
+    Gauge("backup_deleted_files", "Deleted files in the last backup.", "deletedfiles"),
+    Gauge("backup_delta_entries", "Changed entries in the last backup.", "deltaentries"),
+    Gauge("backup_raw_delta_bytes", "Uncompressed size of the changes in the last backup.", "rawdeltasize"),
+    Gauge("backup_throughput_bytes_per_second", "Changed data processed per second.", "throughput"),
+    Gauge("backup_compression_ratio", "Raw delta size per byte written to the destination.", "compression"),
+    Gauge("backup_start_timestamp_seconds", "Start of the last duplicity run.", "starttime"),
+    Gauge("backup_increments", "Incrementals in the current backup chain.", "no_of_inc"),
+    Gauge("backup_errors", "Errors reported by duplicity.", "errors"),
+    Gauge("cleanup_elapsed_seconds", "Duration of remove-all-but-n-full.", "cleanuptime"),
+]
+
+
+@dataclass
+class DurationHistogram:
+    """
+    Cumulative histogram of the duplicity run durations. Prometheus expects bucket counts, sum and count
+    to only grow, so they are kept between runs in a state file.
+    """
+
+    buckets: list[int] = field(default_factory=lambda: [0] * len(DURATION_BUCKETS))
+    sum: float = 0
+    count: int = 0
+
+    @classmethod
+    def load(cls, path: str) -> "DurationHistogram":
+        try:
+            with open(path) as f:
+                histogram = cls(**json.load(f))
+        except FileNotFoundError:
+            return cls()
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring broken metrics state {path}, the histogram starts from zero: {e}")
+            return cls()
+        if len(histogram.buckets) != len(DURATION_BUCKETS):
+            return cls()
+        return histogram
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(self), f)
+        os.replace(tmp_path, path)
+
+    def observe(self, duration: float) -> None:
+        for i, bucket in enumerate(DURATION_BUCKETS):
+            if duration <= bucket:
+                self.buckets[i] += 1
+        self.sum += duration
+        self.count += 1
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _value(stat: BackupStat, field: str) -> float | None:
+    """
+    Numeric value of a stat field, None for unknown values (-1).
+    """
+    try:
+        value = float(getattr(stat, field))
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+def render_metrics(
+    stats: Iterable[BackupStat],
+    success: bool,
+    timestamp: float | None = None,
+    histogram: DurationHistogram | None = None,
+) -> str:
+    """
+    Render the statistics of a run in the Prometheus text format, one series per source directory.
+    Suitable for the node-exporter textfile collector and the Pushgateway.
+    """
+    stats = list(stats)
+    lines = []
+    for gauge in GAUGES:
+        samples = [
+            (stat.source, value)
+            for stat in stats
+            if (value := _value(stat, gauge.field)) is not None
+        ]
+        if not samples:
+            continue
+        lines.append(f"# HELP {PREFIX}_{gauge.name} {gauge.help}")
+        lines.append(f"# TYPE {PREFIX}_{gauge.name} gauge")
+        lines.extend(
+            f'{PREFIX}_{gauge.name}{{source="{_escape(source)}"}} {value:g}'
+            for source, value in samples
+        )
+
+    if histogram is not None:
+        name = f"{PREFIX}_directory_duration_seconds"
+        lines.append(f"# HELP {name} Duration of the duplicity runs of all directories.")
+        lines.append(f"# TYPE {name} histogram")
+        for bucket, count in zip(DURATION_BUCKETS, histogram.buckets):
+            lines.append(f'{name}_bucket{{le="{bucket}"}} {count}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum {histogram.sum:g}")
+        lines.append(f"{name}_count {histogram.count}")
+
+    lines.append(f"# HELP {PREFIX}_last_run_success 1 if the last run finished without errors.")
+    lines.append(f"# TYPE {PREFIX}_last_run_success gauge")
+    lines.append(f"{PREFIX}_last_run_success {int(success)}")
+    lines.append(f"# HELP {PREFIX}_last_run_timestamp_seconds End of the last run.")
+    lines.append(f"# TYPE {PREFIX}_last_run_timestamp_seconds gauge")
+    lines.append(f"{PREFIX}_last_run_timestamp_seconds {timestamp or time.time():.0f}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Export run statistics to a node-exporter textfile and/or a Pushgateway.
+    Export errors are logged only, metrics must never fail a backup.
+    """
+
+    def __init__(
+        self,
+        textfile: str = "",
+        pushgateway_url: str = "",
+        job: str = PREFIX,
+        timeout: float = 10,
+        state_dir: str = "",
+    ) -> None:
+        self.textfile = textfile
+        self.pushgateway_url = pushgateway_url.rstrip("/")
+        self.job = job
+        self.timeout = timeout
+        # the duration histogram is only exported with a place to keep it between runs
+        self.state_path = os.path.join(state_dir, STATE_FILE_NAME) if state_dir else ""
+
+    def __bool__(self) -> bool:
+        return bool(self.textfile or self.pushgateway_url)
+
+    def export(
+        self,
+        stats: Iterable[BackupStat],
+        success: bool,
+        run_stats: Iterable[BackupStat] | None = None,
+    ) -> None:
+        """
+        `run_stats` are the stats of this run, added to the duration histogram. Default: `stats`.
+        """
+        if not self:
+            return
+        stats = list(stats)
+        histogram = None
+        if self.state_path:
+            histogram = DurationHistogram.load(self.state_path)
+            for stat in stats if run_stats is None else run_stats:
+                duration = _value(stat, "elapsedtime")
+                if duration is not None:
+                    histogram.observe(duration)
+            try:
+                os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+                histogram.save(self.state_path)
+            except OSError as e:
+                logger.warning(f"Can't write metrics state {self.state_path}: {e}")
+        text = render_metrics(stats, success, histogram=histogram)
+        if self.textfile:
+            try:
+                self.write_textfile(text)
+            except OSError as e:
+                logger.warning(f"Can't write metrics to {self.textfile}: {e}")
+        if self.pushgateway_url:
+            try:
+                self.push(text)
+            except OSError as e:  # URLError and HTTPError are OSErrors
+                logger.warning(f"Can't push metrics to {self.pushgateway_url}: {e}")
+
+    def write_textfile(self, text: str) -> None:
+        """
+        Write atomically, the textfile collector must never read a partial file.
+        """
+        tmp_path = f"{self.textfile}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, self.textfile)
+
+    def push(self, text: str) -> None:
+        """
+        PUT replaces all metrics of the job group, so directories removed from the config disappear.
+        """
+        import urllib.request  # pulls in http.client and ssl, only needed with a Pushgateway
+
+        url = f"{self.pushgateway_url}/metrics/job/{quote(self.job, safe='')}"
+        request = urllib.request.Request(
+            url,
+            data=text.encode(),
+            method="PUT",
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            logger.info(f"Pushed metrics to {url}: {response.status}")
@@ -0,0 +1,241 @@
+import logging
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+
+def glob_to_regex(pattern: str) -> str:
+    """
+    Translate a duplicity glob (`**` any path, `*` and `?` within a path component, `[...]` classes).
+    """
+    regex, i = "", 0
+    while i < len(pattern):
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        char = pattern[i]
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[" and "]" in pattern[i + 1 :]:
+            end = pattern.index("]", i + 1)
+            regex += "[" + pattern[i + 1 : end].replace("\\", "\\\\") + "]"
+            i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+    return regex
+
+
+@dataclass
+class Selection:
+    """
+    One --include/--exclude option, duplicity applies the first matching one.
+    """
+
+    include: bool
+    regex: re.Pattern
+    literal_prefix: str = ""  # path up to the first wildcard, its parents are scanned for includes
+
+    @classmethod
+    def from_glob(cls, include: bool, pattern: str) -> "Selection":
+        flags = 0
+        if pattern.startswith("ignorecase:"):
+            pattern, flags = pattern[len("ignorecase:") :], re.IGNORECASE
+        pattern = pattern.rstrip("/") or "/"
+        prefix = re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+        # a pattern matching a directory selects everything inside of it
+        return cls(include, re.compile(f"{glob_to_regex(pattern)}(/.*)?", flags), prefix)
+
+    def matches(self, path: str, is_dir: bool) -> bool | None:
+        """
+        True if selected, None for parent directories of an include, which are scanned but not selected.
+        """
+        if self.regex.fullmatch(path):
+            return True
+        if self.include and is_dir and self.literal_prefix.startswith(path.rstrip("/") + "/"):
+            return None
+        return False
+
+
+@dataclass
+class SourceFilter:
+    selections: list[Selection] = field(default_factory=list)
+    exclude_if_present: list[str] = field(default_factory=list)
+    exclude_other_filesystems: bool = False
+
+    @classmethod
+    def from_args(cls, args: List[str]) -> "SourceFilter":
+        """
+        Selection options of duplicity in `args`, as `--option value` or `--option=value`.
+        """
+        source_filter = cls()
+        i = 0
+        while i < len(args):
+            name, separator, value = args[i].partition("=")
+            takes_value = name in [
+                "--include",
+                "--exclude",
+                "--include-regexp",
+                "--exclude-regexp",
+                "--include-filelist",
+                "--exclude-filelist",
+                "--exclude-if-present",
+            ]
+            if takes_value and not separator and i + 1 < len(args):
+                i += 1
+                value = args[i]
+            if name in ["--include", "--exclude"]:
+                source_filter.selections.append(Selection.from_glob(name == "--include", value))
+            elif name in ["--include-regexp", "--exclude-regexp"]:
+                source_filter.selections.append(
+                    Selection(name == "--include-regexp", re.compile(f".*(?:{value}).*"))
+                )
+            elif name in ["--include-filelist", "--exclude-filelist"]:
+                source_filter.selections.extend(
+                    _read_filelist(value, include=name == "--include-filelist")
+                )
+            elif name == "--exclude-if-present":
+                source_filter.exclude_if_present.append(value)
+            elif name == "--exclude-other-filesystems":
+                source_filter.exclude_other_filesystems = True
+            i += 1
+        return source_filter
+
+    def is_selected(self, path: str, is_dir: bool) -> bool:
+        for selection in self.selections:
+            match = selection.matches(path, is_dir)
+            if match is None:
+                return True
+            if match:
+                return selection.include
+        return True
+
+
+def _read_filelist(path: str, include: bool) -> list[Selection]:
+    """
+    Lines are globs, prefixed with `+ ` or `- ` to include or exclude regardless of the option.
+    """
+    selections = []
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                line_include = include
+                if line[:2] in ["+ ", "- "]:
+                    line_include, line = line[0] == "+", line[2:]
+                selections.append(Selection.from_glob(line_include, line))
+    except OSError as e:
+        logger.warning(f"Can't read file list {path}, pre-flight ignores it: {e}")
+    return selections
+
+
+@dataclass
+class SourceScan:
+    source: str
+    files: int = 0
+    size: int = 0
+    changed_files: int = 0  # modified after `since`
+    changed_size: int = 0
+    errors: list[str] = field(default_factory=list)
+    missing: bool = False
+    seconds: float = 0
+
+
+@dataclass
+class _DirResult:
+    files: int = 0
+    size: int = 0
+    changed_files: int = 0
+    changed_size: int = 0
+    subdirs: list[str] = field(default_factory=list)
+    errors: list[str] = field(default_factory=list)
+
+
+def _scan_dir(
+    path: str, source_filter: SourceFilter, since: float | None, root_dev: int
+) -> _DirResult:
+    result = _DirResult()
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+        names = {entry.name for entry in entries}
+        if any(name in names for name in source_filter.exclude_if_present):
+            return result
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not source_filter.is_selected(entry.path, is_dir):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if is_dir:
+                    if not (source_filter.exclude_other_filesystems and st.st_dev != root_dev):
+                        result.subdirs.append(entry.path)
+                    continue
+                result.files += 1
+                result.size += st.st_size
+                if since is not None and max(st.st_mtime, st.st_ctime) > since:
+                    result.changed_files += 1
+                    result.changed_size += st.st_size
+            except OSError as e:
+                result.errors.append(f"{entry.path}: {e.strerror}")
+    except OSError as e:
+        result.errors.append(f"{path}: {e.strerror}")
+    return result
+
+
+def preflight_scan(
+    sources: List[str],
+    args: List[str] | None = None,
+    since: dict[str, float] | None = None,
+    workers: int = 8,
+) -> list[SourceScan]:
+    """
+    Walk all `sources` in parallel, one os.scandir per task, honouring the duplicity selection options in `args`.
+    Excluded directories are pruned, not walked. Files modified after `since[source]` count as changed.
+    """
+    source_filter = SourceFilter.from_args(args or [])
+    since = since or {}
+    scans = {source: SourceScan(source) for source in sources}
+    started = {source: time.monotonic() for source in sources}
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="preflight") as executor:
+        pending: dict[Future, tuple[str, int]] = {}
+        for source in sources:
+            try:
+                root_dev = os.stat(source).st_dev
+            except FileNotFoundError:
+                scans[source].missing = True
+                scans[source].errors.append(f"{source}: source not found")
+                continue
+            except OSError as e:
+                scans[source].errors.append(f"{source}: {e.strerror}")
+                continue
+            pending[
+                executor.submit(_scan_dir, source, source_filter, since.get(source), root_dev)
+            ] = (source, root_dev)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, root_dev = pending.pop(future)
+                result = future.result()
+                scan = scans[source]
+                scan.files += result.files
+                scan.size += result.size
+                scan.changed_files += result.changed_files
+                scan.changed_size += result.changed_size
+                scan.errors.extend(result.errors)
+                for subdir in result.subdirs:
+                    pending[
+                        executor.submit(_scan_dir, subdir, source_filter, since.get(source), root_dev)
+                    ] = (source, root_dev)
+                scan.seconds = time.monotonic() - started[source]
+    return [scans[source] for source in sources]
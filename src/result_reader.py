@@ -1,25 +1,237 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, asdict
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from pprint import pprint as print
-import smtplib
-import ssl
-from typing import Callable
-import regex as re
+from typing import TYPE_CHECKING, Callable, ClassVar
 import json
-from prettytable import PrettyTable
 
+# email and table rendering are only loaded to send a report
+if TYPE_CHECKING:
+    from prettytable import PrettyTable
 
-@dataclass
+
+def format_size(size: float) -> str:
+    if size < 0:
+        return "?"
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+@dataclass(slots=True)
 class BackupStat:
+    """
+    Statistics of one duplicity run, as reported with --jsonstat. -1 marks unknown values.
+    """
+
     source: str
     newfiles: int = -1
     deltaentries: int = -1
     no_of_inc: int = -1
-    elapsedtime: str = "?"
+    elapsedtime: float = -1
     errors: int = -1
+    action: str = ""
+    sourcefiles: int = -1
+    sourcefilesize: int = -1
+    newfilesize: int = -1
+    changedfiles: int = -1
+    changedfilesize: int = -1
+    changeddeltasize: int = -1
+    deletedfiles: int = -1
+    rawdeltasize: int = -1
+    destsizechange: int = -1
+    starttime: float = -1
+    endtime: float = -1
+    cleanuptime: float = -1
+
+    # jsonstat key per field, fields without a key are filled from backup_meta or by the caller
+    JSON_KEYS: ClassVar[dict[str, str]] = {
+        "newfiles": "NewFiles",
+        "deltaentries": "DeltaEntries",
+        "elapsedtime": "ElapsedTime",
+        "errors": "Errors",
+        "sourcefiles": "SourceFiles",
+        "sourcefilesize": "SourceFileSize",
+        "newfilesize": "NewFileSize",
+        "changedfiles": "ChangedFiles",
+        "changedfilesize": "ChangedFileSize",
+        "changeddeltasize": "ChangedDeltaSize",
+        "deletedfiles": "DeletedFiles",
+        "rawdeltasize": "RawDeltaSize",
+        "destsizechange": "TotalDestinationSizeChange",
+        "starttime": "StartTime",
+        "endtime": "EndTime",
+    }
+
+    @property
+    def throughput(self) -> float:
+        """
+        Bytes of changed data processed per second, -1 if unknown.
+        """
+        if self.rawdeltasize < 0 or self.elapsedtime <= 0:
+            return -1
+        return self.rawdeltasize / self.elapsedtime
+
+    @property
+    def compression(self) -> float:
+        """
+        Ratio of changed data to bytes added to the destination, -1 if unknown.
+        Includes compression and the overhead of encryption and signatures.
+        """
+        if self.rawdeltasize <= 0 or self.destsizechange <= 0:
+            return -1
+        return self.rawdeltasize / self.destsizechange
+
+    REPORT_COLUMNS: ClassVar[list[str]] = [
+        "source",
+        "action",
+        "new",
+        "changed",
+        "deleted",
+        "deltas",
+        "no_of_inc",
+        "size",
+        "uploaded",
+        "elapsed s",
+        "MB/s",
+        "ratio",
+        "errors",
+    ]
+
+    def report_row(self) -> list:
+        """
+        Values for REPORT_COLUMNS, formatted for humans.
+        """
+
+        def known(value, fmt="{}"):
+            return fmt.format(value) if value >= 0 else "?"
+
+        return [
+            self.source,
+            self.action,
+            known(self.newfiles),
+            known(self.changedfiles),
+            known(self.deletedfiles),
+            known(self.deltaentries),
+            known(self.no_of_inc),
+            format_size(self.sourcefilesize),
+            format_size(self.destsizechange),
+            known(self.elapsedtime, "{:.2f}"),
+            known(self.throughput / 1e6 if self.throughput >= 0 else -1, "{:.2f}"),
+            known(self.compression, "{:.2f}"),
+            known(self.errors),
+        ]
+
+
+class JsonStreamDecoder:
+    """
+    Incremental decoder for JSON objects embedded in plain text, e.g. duplicity output with --jsonstat.
+    Text is fed chunk by chunk, top level objects are decoded as soon as their closing brace arrives.
+    Only the currently open object is buffered, up to `max_object_size` characters.
+    """
+
+    def __init__(self, max_object_size: int = 1024 * 1024) -> None:
+        self.max_object_size = max_object_size
+        self._reset()
+
+    def _reset(self) -> None:
+        self._buffer: list[str] = []
+        self._size = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> tuple[list[dict], list[str]]:
+        """
+        Returns the objects completed by `text` and the plain text around them.
+        """
+        objects: list[dict] = []
+        plain: list[str] = []
+        pos = 0
+        if self._depth == 0 and "{" not in text:
+            return objects, [text]
+        while pos < len(text):
+            if self._depth == 0:
+                start = text.find("{", pos)
+                if start < 0:
+                    plain.append(text[pos:])
+                    break
+                if start > pos:
+                    plain.append(text[pos:start])
+                pos = start
+            end = self._scan(text, pos)
+            self._buffer.append(text[pos:end])
+            self._size += end - pos
+            pos = end
+            if self._depth == 0:
+                blob = "".join(self._buffer)
+                self._reset()
+                try:
+                    objects.append(json.loads(blob))
+                    continue
+                except ValueError:
+                    pass
+            elif self._size > self.max_object_size:
+                blob = "".join(self._buffer)
+                self._reset()
+            else:
+                continue
+            # not decodable, e.g. a brace in plain output: the first brace is plain text,
+            # search the rest again for objects
+            next_start = blob.find("{", 1)
+            if next_start < 0:
+                plain.append(blob)
+                continue
+            plain.append(blob[:next_start])
+            text = blob[next_start:] + text[pos:]
+            pos = 0
+        return objects, plain
+
+    def flush(self) -> tuple[list[dict], list[str]]:
+        """
+        Decode what is left of an unclosed blob at the end of the stream.
+        """
+        objects: list[dict] = []
+        plain: list[str] = []
+        while self._buffer:
+            blob = "".join(self._buffer)
+            self._reset()
+            next_start = blob.find("{", 1)
+            if next_start < 0:
+                plain.append(blob)
+                break
+            plain.append(blob[:next_start])
+            new_objects, new_plain = self.feed(blob[next_start:])
+            objects.extend(new_objects)
+            plain.extend(new_plain)
+        return objects, plain
+
+    def _scan(self, text: str, pos: int) -> int:
+        """
+        Track braces and strings from `pos`, return the position after the closing brace
+        of the current top level object or the end of `text`.
+        """
+        for i in range(pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    return i + 1
+        return len(text)
 
 
 class Sender(ABC):
@@ -76,11 +288,13 @@ class EmailSender(Sender):
     def get_params(cls) -> Callable:
         return cls.EmailParameter
 
-    def __render_table(self, report_list: list[BackupStat]) -> PrettyTable:
+    def __render_table(self, report_list: list[BackupStat]) -> "PrettyTable":
+        from prettytable import PrettyTable
+
         table = PrettyTable()
-        table.field_names = asdict(report_list[0]).keys()
+        table.field_names = BackupStat.REPORT_COLUMNS
         for row in report_list:
-            table.add_row(asdict(row).values())
+            table.add_row(row.report_row())
         return table
 
     def _rendert_text(
@@ -119,6 +333,11 @@ class EmailSender(Sender):
         error="",
         footer="",
     ):
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        import smtplib
+        import ssl
+
         text = self._rendert_text(
             report_list, f"{status} - {header}", info=info, error=error, footer=footer
         )
@@ -148,20 +367,54 @@ class EmailSender(Sender):
 
 
 class ResultReader:
+    TAIL_LINES = 200
+
     def __init__(self, sender, title="") -> None:
         self.title: str = title
-        self.json = ""
+        self.tail: deque[str] = deque(maxlen=self.TAIL_LINES)
         self.plain = ""
         self.error_msg = ""
         self.footer = ""
+        self.skipped: list[tuple[str, str]] = []
         self.stats: list[BackupStat] = []
         self.sender: Sender = sender
+        self._decoder = JsonStreamDecoder()
 
     def add_json(self, input: str):
         """
-        add string containging JSON blobs
+        add string containging JSON blobs, statistics are parsed as soon as a blob is complete.
+        Only the last `TAIL_LINES` lines of other output are kept.
+        """
+        self._add_decoded(*self._decoder.feed(input))
+
+    def flush(self):
+        """
+        decode output left over from an unclosed JSON blob
         """
-        self.json += input
+        self._add_decoded(*self._decoder.flush())
+
+    def _add_decoded(self, objects: list[dict], plain: list[str]):
+        for result in objects:
+            if "backup_meta" in result:
+                self.stats.append(self._parse_stat(result))
+        for text in plain:
+            text = text.rstrip("\n")
+            if text.strip():
+                self.tail.append(text)
+
+    @staticmethod
+    def _parse_stat(result: dict) -> BackupStat:
+        backup_meta = result["backup_meta"]
+        stat = BackupStat(
+            backup_meta.get("source", "Error no source"),
+            no_of_inc=backup_meta.get("no_of_inc", -1),
+            action=backup_meta.get("action", ""),
+        )
+        for field, key in BackupStat.JSON_KEYS.items():
+            value = result.get(key)
+            if isinstance(value, (int, float)):
+                setattr(stat, field, value)
+        return stat
 
     def add_plain(self, input: str):
         """
@@ -181,32 +434,48 @@ class ResultReader:
         """
         self.footer += "\n\n" + input if self.footer else input
 
+    def add_skipped(self, source: str, reason: str):
+        """
+        add a directory which was not backed up, with the reason why
+        """
+        self.skipped.append((source, reason))
+
+    def _render_skipped(self) -> str:
+        return "Skipped directories:\n" + "\n".join(
+            f"- {source}: {reason}" for source, reason in self.skipped
+        )
+
+    def merge(self, other: "ResultReader") -> None:
+        """
+        merge output collected by another ResultReader, e.g. of a single directory job
+        """
+        other.flush()
+        self.stats.extend(other.stats)
+        self.tail.extend(other.tail)
+        self.skipped.extend(other.skipped)
+        if other.plain:
+            self.add_plain(other.plain)
+        if other.error_msg:
+            self.add_error(other.error_msg)
+        if other.footer:
+            self.add_footer(other.footer)
+
     def parse_and_send(self) -> None:
         """
         parse all received information and send report
         """
-        pattern = re.compile(r"\{(?:[^{}]|(?R))*\}")
-        json_blobs = pattern.findall(self.json)
+        self.flush()
         status = "Unknown"
+        if self.skipped:
+            self.add_plain(self._render_skipped())
         no_errors = 0
         no_delta = 0
-        for result_str in json_blobs:
-            result = json.loads(result_str)
-            elapsed_time = result.get("ElapsedTime", -1)
-            bs = BackupStat(
-                result["backup_meta"].get("source", "Error no source"),
-                result.get("NewFiles", -1),
-                result.get("DeltaEntries", -1),
-                result["backup_meta"].get("no_of_inc", -1),
-                f'{elapsed_time:.2f}',
-                result.get("Errors", -1),
-            )
-            self.stats.append(bs)
+        for bs in self.stats:
             if bs.errors > 0:
                 no_errors += bs.errors
             if bs.deltaentries > 0:
                 no_delta += bs.deltaentries
-        if len(self.stats) >= 1:
+        if len(self.stats) >= 1 or self.skipped:
             status = "OK" if no_errors == 0 or self.error_msg else "ERROR"
             status = f"{status}: {no_delta} changes."
             self.sender.send(
@@ -222,6 +491,6 @@ class ResultReader:
                 [BackupStat("Fatal Error")],
                 "Fatal Error",
                 error="no results found in duplicity output",
-                info=self.json,
+                info="\n".join(self.tail),
                 footer=self.footer,
             )
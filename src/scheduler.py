@@ -0,0 +1,124 @@
+import heapq
+import json
+import logging
+import os
+import statistics
+from dataclasses import dataclass
+
+from history import RunHistory
+
+logger = logging.getLogger(__name__)
+
+DEFERRED_FILE_NAME = "dupback-deferred.json"
+
+
+@dataclass
+class Job:
+    item: str  # entry of `directories`
+    source: str
+    estimate: float | None = None  # seconds, None if unknown
+    size: int | None = None  # bytes of the source, from the pre-flight scan
+    priority: bool = False  # deferred by the last run
+
+
+def estimate_seconds(history: RunHistory, source: str, full: bool) -> float | None:
+    """
+    Expected duration of the next run of `source` from its history:
+    the last full backup for a full, the median of the last incrementals otherwise.
+    """
+    past = [stat for stat in history.query(source, limit=20) if stat.elapsedtime >= 0]
+    fulls = [stat.elapsedtime for stat in past if stat.action == "full"]
+    incs = [stat.elapsedtime for stat in past if stat.action != "full"][:5]
+    if full:
+        return fulls[0] if fulls else max(incs, default=None)
+    return statistics.median(incs) if incs else None
+
+
+class JobScheduler:
+    """
+    Order directory jobs and fit them into a nightly window.
+
+    Jobs deferred by the last run start first and are never deferred again, jobs without history
+    (e.g. new directories) follow, then the rest, longest first with `longest_first`.
+    Jobs without history are ordered by their size, if known.
+    With a window, the run is simulated on `parallelism` workers: a job which would end after
+    the window is deferred, smaller jobs after it may still fit.
+    """
+
+    def __init__(
+        self,
+        archive_dir: str,
+        parallelism: int = 1,
+        window_minutes: int = 0,
+        longest_first: bool = True,
+    ) -> None:
+        self.path = os.path.join(archive_dir, DEFERRED_FILE_NAME)
+        self.parallelism = max(1, parallelism)
+        self.window = window_minutes * 60
+        self.longest_first = longest_first
+
+    def _load_deferred(self) -> list[str]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError as e:
+            logger.warning(f"Ignoring broken list of deferred jobs {self.path}: {e}")
+            return []
+
+    def _save_deferred(self, items: list[str]) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(items, f)
+        os.replace(tmp_path, self.path)
+
+    def plan(self, jobs: list[Job]) -> tuple[list[Job], list[tuple[Job, str]]]:
+        """
+        Returns the jobs to run in order and the deferred jobs with the reason.
+        """
+        deferred_last_run = set(self._load_deferred())
+        for job in jobs:
+            job.priority = job.item in deferred_last_run
+        priority = [job for job in jobs if job.priority]
+        unknown = [job for job in jobs if not job.priority and job.estimate is None]
+        known = [job for job in jobs if not job.priority and job.estimate is not None]
+        if self.longest_first:
+            known.sort(key=lambda job: job.estimate, reverse=True)  # type: ignore
+            unknown.sort(key=lambda job: job.size or 0, reverse=True)
+            ordered = priority + unknown + known
+        else:
+            ordered = priority + [job for job in jobs if not job.priority]
+
+        scheduled: list[Job] = []
+        deferred: list[tuple[Job, str]] = []
+        estimates = [job.estimate for job in known if job.estimate is not None]
+        default_estimate = statistics.median(estimates) if estimates else 0
+        workers = [0.0] * self.parallelism  # end time of each worker, a heap
+        for job in ordered:
+            estimate = job.estimate if job.estimate is not None else default_estimate
+            start = workers[0]
+            if (
+                self.window
+                and not job.priority
+                and job.estimate is not None
+                and start + estimate > self.window
+            ):
+                deferred.append(
+                    (
+                        job,
+                        f"deferred to the next run, estimated {estimate / 60:.0f} min "
+                        f"from minute {start / 60:.0f} exceed the {self.window / 60:.0f} min window",
+                    )
+                )
+                continue
+            heapq.heapreplace(workers, start + estimate)
+            scheduled.append(job)
+        if self.window:
+            self._save_deferred([job.item for job, _ in deferred])
+        logger.info(
+            f"Job order: {[job.item for job in scheduled]}, estimated end after "
+            f"{max(workers) / 60:.0f} min, deferred: {[job.item for job, _ in deferred]}"
+        )
+        return scheduled, deferred
@@ -0,0 +1,196 @@
+import json
+import logging
+import math
+import os
+import re
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List
+
+from preflight import preflight_scan
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = "dupback-shards.json"
+REST_SHARD = "rest"
+
+
+def _escape_glob(path: str) -> str:
+    return re.sub(r"([*?\[\]])", r"[\1]", path)
+
+
+@dataclass
+class Shard:
+    """
+    Part of a directory backed up as its own duplicity target.
+    `paths` are relative to the directory, the rest shard has none and takes everything else.
+    """
+
+    name: str
+    paths: list[str] = field(default_factory=list)
+    size: int = 0  # at the time the layout was created
+
+    def duplicity_args(self, source: str, assigned: list[str]) -> list[str]:
+        """
+        Selection options for duplicity, `assigned` are the paths of all shards of the directory.
+        """
+        if self.name == REST_SHARD:
+            args = []
+            for path in assigned:
+                args += ["--exclude", _escape_glob(os.path.join(source, path))]
+            return args
+        args = []
+        for path in self.paths:
+            args += ["--include", _escape_glob(os.path.join(source, path))]
+        return args + ["--exclude", "**"]
+
+    def covers(self, path: str, assigned: list[str]) -> bool:
+        """
+        True if a change at `path`, relative to the directory, may need a backup of this shard.
+        Changes of parents of the shard paths count for the shards below them, too.
+        """
+        if self.name == REST_SHARD:
+            return not any(path == p or path.startswith(f"{p}/") for p in assigned)
+        return path == "" or any(
+            path == p or path.startswith(f"{p}/") or p.startswith(f"{path}/") for p in self.paths
+        )
+
+
+@dataclass
+class ShardLayout:
+    item: str  # entry of `directories`
+    shards: list[Shard]
+    created: float = field(default_factory=time.time)
+
+    @property
+    def assigned(self) -> list[str]:
+        return [path for shard in self.shards for path in shard.paths]
+
+    def job_name(self, shard: Shard) -> str:
+        """
+        Name of the shard job, also the name of its target below `dest.baseDir`.
+        """
+        return f"{self.item}.{shard.name}"
+
+
+class ShardManifest:
+    """
+    Layout of all sharded directories, stored next to the duplicity archive dir.
+    A layout is kept once created: changing it would start new chains for all shards.
+    Subdirectories created later go to the rest shard.
+    """
+
+    def __init__(self, archive_dir: str) -> None:
+        self.path = os.path.join(archive_dir, MANIFEST_FILE_NAME)
+        self.layouts: dict[str, ShardLayout] = {}
+        try:
+            with open(self.path) as f:
+                for item, layout in json.load(f).items():
+                    shards = [Shard(**shard) for shard in layout["shards"]]
+                    self.layouts[item] = ShardLayout(item, shards, layout["created"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            # losing the layout would start new chains for every shard, don't overwrite it silently
+            raise ValueError(f"Broken shard manifest {self.path}: {e}") from e
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {item: asdict(layout) for item, layout in self.layouts.items()},
+                f,
+                indent=1,
+            )
+        os.replace(tmp_path, self.path)
+
+
+def plan_shards(
+    source: str,
+    item: str,
+    size: int,
+    files: int,
+    max_size: int = 0,
+    max_files: int = 0,
+    max_depth: int = 3,
+    args: List[str] | None = None,
+    workers: int = 8,
+) -> ShardLayout | None:
+    """
+    Split `source` into shards below `max_size` bytes and `max_files` files (0: no limit).
+    Subdirectories larger than a shard are split further, down to `max_depth` levels.
+    The subdirectories are distributed over the shards largest first, each to the smallest shard,
+    with more shards than the limits require if needed to keep every shard below them.
+    Returns None if the directory is small enough.
+    """
+    shard_count = max(
+        math.ceil(size / max_size) if max_size else 1,
+        math.ceil(files / max_files) if max_files else 1,
+    )
+    if shard_count <= 1:
+        return None
+
+    def weight(scan) -> float:
+        # share of the limits, files and bytes are comparable this way
+        return max(
+            scan.size / max_size if max_size else 0,
+            scan.files / max_files if max_files else 0,
+        )
+
+    def scan_subdirs(path: str) -> list:
+        try:
+            subdirs = [entry.path for entry in os.scandir(path) if entry.is_dir(follow_symlinks=False)]
+        except OSError as e:
+            logger.warning(f"Can't list {path} for sharding: {e}")
+            return []
+        return [scan for scan in preflight_scan(subdirs, args, workers=workers) if not scan.missing]
+
+    # subdirectories with their depth below `source`, split until none is larger than a shard
+    to_split = [(scan, 1) for scan in scan_subdirs(source)]
+    candidates = []
+    while to_split:
+        scan, depth = to_split.pop()
+        children = scan_subdirs(scan.source) if weight(scan) > 1 and depth < max_depth else []
+        if children:
+            # files directly in the split directory go to the rest shard
+            to_split += [(child, depth + 1) for child in children]
+        else:
+            candidates.append((scan, depth))
+    candidates.sort(key=lambda candidate: weight(candidate[0]), reverse=True)
+    if len(candidates) < 2:
+        logger.warning(f"{source} has no subdirectories to shard by, backed up as one target.")
+        return None
+
+    for scan, _ in candidates:
+        if weight(scan) > 1:
+            logger.warning(
+                f"{scan.source} alone is above the shard limits and can't be split further "
+                f"(max depth {max_depth}), its shard will be larger."
+            )
+
+    def assign(count: int) -> tuple[list[Shard], list[float]]:
+        shards = [Shard(f"shard-{i + 1:02d}") for i in range(count)]
+        loads = [0.0] * count
+        for scan, _ in candidates:
+            i = loads.index(min(loads))
+            loads[i] += weight(scan)
+            shards[i].paths.append(os.path.relpath(scan.source, source))
+            shards[i].size += scan.size
+        return shards, loads
+
+    def overfull(shards: list[Shard], loads: list[float]) -> bool:
+        # a shard of a single oversized candidate can't get smaller with more shards
+        return any(load > 1 and len(shard.paths) > 1 for shard, load in zip(shards, loads))
+
+    # the limits are bounds, not averages: add shards until none is above them
+    shard_count = min(shard_count, len(candidates))
+    shards, loads = assign(shard_count)
+    while overfull(shards, loads) and shard_count < len(candidates):
+        shard_count += 1
+        shards, loads = assign(shard_count)
+    for shard in shards:
+        shard.paths.sort()
+    rest_size = size - sum(shard.size for shard in shards)
+    shards.append(Shard(REST_SHARD, [], max(rest_size, 0)))
+    return ShardLayout(item, shards)
@@ -0,0 +1,146 @@
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from botocore.exceptions import ClientError
+
+import helper_initiate_glacier_restore as helper
+
+BUCKET = "backups"
+FULL = "20240101T010203Z"
+INC = "20240108T010203Z"
+NEXT_FULL = "20240201T010203Z"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def put(s3, key, storage_class="GLACIER"):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=b"x", StorageClass=storage_class)
+
+
+def is_requested(s3, key):
+    return "Restore" in s3.head_object(Bucket=BUCKET, Key=key)
+
+
+def record_tiers(s3):
+    tiers = {}
+
+    def before_restore(params, **kwargs):
+        tiers[params["Key"]] = params["RestoreRequest"]["GlacierJobParameters"]["Tier"]
+
+    s3.meta.events.register("provide-client-params.s3.RestoreObject", before_restore)
+    return tiers
+
+
+def fast_limiter():
+    return helper.TokenBucket(rate=1000, burst=1000)
+
+
+def test_restore_keys_initiates_once(s3):
+    keys = [f"photos/duplicity-full.{FULL}.vol{i}.difftar.gpg" for i in range(1, 6)]
+    for key in keys:
+        put(s3, key)
+
+    states = helper.restore_keys(s3, BUCKET, keys, workers=4, limiter=fast_limiter())
+    assert states == {"initiated": 5}
+    assert all(is_requested(s3, key) for key in keys)
+
+    # moto thaws at once, nothing is requested twice
+    assert helper.restore_keys(s3, BUCKET, keys, workers=4, limiter=fast_limiter()) == {"restored": 5}
+
+
+def test_deep_archive_is_requested_with_standard(s3):
+    put(s3, "glacier.difftar.gpg")
+    put(s3, "deep.difftar.gpg", "DEEP_ARCHIVE")
+    tiers = record_tiers(s3)
+
+    states = helper.restore_keys(
+        s3, BUCKET, ["glacier.difftar.gpg", "deep.difftar.gpg"], tier="Expedited", limiter=fast_limiter()
+    )
+    assert states == {"initiated": 2}
+    assert tiers == {"glacier.difftar.gpg": "Expedited", "deep.difftar.gpg": "Standard"}
+
+
+def test_dry_run_requests_nothing(s3):
+    put(s3, "a.difftar.gpg")
+    tiers = record_tiers(s3)
+
+    assert helper.restore_keys(s3, BUCKET, ["a.difftar.gpg"], dry_run=True, limiter=fast_limiter()) == {
+        "dry-run": 1
+    }
+    assert tiers == {}
+    assert not is_requested(s3, "a.difftar.gpg")
+
+
+def test_failed_keys_are_collected(s3):
+    put(s3, "a.difftar.gpg")
+    failed_keys = []
+
+    states = helper.restore_keys(
+        s3, BUCKET, ["a.difftar.gpg", "missing.difftar.gpg"], limiter=fast_limiter(), failed_keys=failed_keys
+    )
+    assert states == {"initiated": 1, "failed": 1}
+    assert failed_keys == ["missing.difftar.gpg"]
+
+
+def test_initiate_restore_by_pattern(s3):
+    put(s3, f"photos/duplicity-full.{FULL}.vol1.difftar.gpg")
+    put(s3, f"photos/duplicity-full.{FULL}.vol2.difftar.gpg")
+    put(s3, f"photos/duplicity-full.{FULL}.manifest.gpg")
+    put(s3, f"photos/duplicity-full.{FULL}.vol3.difftar.gpg", "STANDARD")
+
+    states = helper.initiate_restore(BUCKET, "photos/duplicity-*.difftar.gpg", workers=2, rate=1000, burst=1000)
+    assert states == {"initiated": 2}
+    assert not is_requested(s3, f"photos/duplicity-full.{FULL}.manifest.gpg")
+
+
+def test_initiate_chain_restore_thaws_only_the_chain(s3):
+    chain = [
+        f"photos/duplicity-full.{FULL}.manifest.gpg",
+        f"photos/duplicity-full.{FULL}.vol1.difftar.gpg",
+        f"photos/duplicity-full.{FULL}.vol2.difftar.gpg",
+        f"photos/duplicity-full-signatures.{FULL}.sigtar.gpg",
+        f"photos/duplicity-inc.{FULL}.to.{INC}.manifest.gpg",
+        f"photos/duplicity-inc.{FULL}.to.{INC}.vol1.difftar.gpg",
+        f"photos/duplicity-new-signatures.{FULL}.to.{INC}.sigtar.gpg",
+    ]
+    later = [
+        f"photos/duplicity-full.{NEXT_FULL}.manifest.gpg",
+        f"photos/duplicity-full.{NEXT_FULL}.vol1.difftar.gpg",
+    ]
+    for key in chain + later:
+        put(s3, key)
+
+    states = helper.initiate_chain_restore(BUCKET, "photos", "20240115T000000Z", rate=1000, burst=1000)
+    assert states == {"initiated": len(chain)}
+    assert all(is_requested(s3, key) for key in chain)
+    assert not any(is_requested(s3, key) for key in later)
+
+
+def test_throttling_is_retried():
+    calls = []
+
+    def throttled_once(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise ClientError({"Error": {"Code": "SlowDown"}}, "RestoreObject")
+        return "done"
+
+    assert helper.with_retry(throttled_once, base_delay=0, Key="a") == "done"
+    assert len(calls) == 2
+
+    def denied(**kwargs):
+        raise ClientError({"Error": {"Code": "AccessDenied"}}, "RestoreObject")
+
+    with pytest.raises(ClientError):
+        helper.with_retry(denied, base_delay=0, Key="a")
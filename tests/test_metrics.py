@@ -0,0 +1,101 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from metrics import CONTENT_TYPE, MetricsExporter
+from result_reader import BackupStat
+
+
+class Pushgateway(ThreadingHTTPServer):
+    """
+    Local stand-in for a Pushgateway, records the requests and answers with `status`.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), PushHandler)
+        self.requests: list[tuple[str, str, str, str]] = []  # method, path, content type, body
+        self.status = 200
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/"
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    def do_PUT(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self.server.requests.append((self.command, self.path, self.headers["Content-Type"], body))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def pushgateway():
+    server = Pushgateway()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stats():
+    return [
+        BackupStat(source="/data/photos", elapsedtime=42.5, sourcefiles=1200, errors=0),
+        BackupStat(source='/data/"quoted"', elapsedtime=700, sourcefiles=3, errors=0),
+    ]
+
+
+def test_push_replaces_the_job_group(pushgateway):
+    MetricsExporter(pushgateway_url=pushgateway.url, job="dupback/node1").export(stats(), True)
+
+    [(method, path, content_type, body)] = pushgateway.requests
+    assert method == "PUT"
+    assert path == "/metrics/job/dupback%2Fnode1"
+    assert content_type == CONTENT_TYPE
+    assert 'dupback_backup_elapsed_seconds{source="/data/photos"} 42.5' in body
+    assert 'dupback_backup_source_files{source="/data/\\"quoted\\""} 3' in body
+    assert "dupback_last_run_success 1" in body
+    assert "directory_duration_seconds" not in body  # no state dir, no histogram
+
+
+def test_histogram_accumulates_across_pushes(pushgateway, tmp_path):
+    exporter = MetricsExporter(pushgateway_url=pushgateway.url, state_dir=str(tmp_path))
+    exporter.export(stats(), True)
+    exporter.export(stats()[:1], False)
+
+    body = pushgateway.requests[-1][3]
+    assert 'dupback_directory_duration_seconds_bucket{le="60"} 2' in body
+    assert 'dupback_directory_duration_seconds_bucket{le="900"} 3' in body
+    assert "dupback_directory_duration_seconds_count 3" in body
+    assert "dupback_directory_duration_seconds_sum 785" in body
+    assert "dupback_last_run_success 0" in body
+
+
+def test_push_errors_never_fail_the_backup(pushgateway, tmp_path, caplog):
+    pushgateway.status = 500
+    textfile = tmp_path / "dupback.prom"
+    exporter = MetricsExporter(textfile=str(textfile), pushgateway_url=pushgateway.url)
+
+    with caplog.at_level(logging.WARNING, logger="metrics"):
+        exporter.export(stats(), True)
+
+    assert len(pushgateway.requests) == 1
+    assert "Can't push metrics" in caplog.text
+    assert "dupback_last_run_success 1" in textfile.read_text()
+
+
+def test_unreachable_pushgateway_is_logged(pushgateway, caplog):
+    url = pushgateway.url
+    pushgateway.shutdown()
+    pushgateway.server_close()
+
+    with caplog.at_level(logging.WARNING, logger="metrics"):
+        MetricsExporter(pushgateway_url=url, timeout=2).export(stats(), True)
+
+    assert "Can't push metrics" in caplog.text